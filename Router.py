@@ -1,9 +1,23 @@
 import asyncio  # noqa: D100
+import difflib
 import json
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+from copy import deepcopy
 
 from .actions.action import Action
+from .const import (
+    DATA_PATH,
+    DEFAULT_ROUTER_CACHE_FUZZY_THRESHOLD,
+    DEFAULT_ROUTER_CACHE_SIZE,
+    DEFAULT_ROUTER_CACHE_TTL,
+)
 from .llm import LLM
 from .utils.logs import _logger
+from .utils.parser import ParseError, parse_json, require_keys
+from .utils.singleton import Singleton
 
 SYSTEM_MESSAGE = """
 你需要将用户需求分解为若干子任务，并解析它们之间的依赖关系。对于每个子任务的内容，你只需要重复用户的这部分自然语言，而不需要归纳总结。
@@ -85,38 +99,139 @@ User Input: 告诉我现在的天气？还有家中有哪些可用的设备？
 USER_MESSAGE = """user_request: {user_request}"""
 
 
+class DecompositionCache(metaclass=Singleton):
+    """任务分解结果的缓存，所有会话共享，按规范化后的请求文本索引，LRU淘汰并持久化到DATA_PATH."""
+
+    def __init__(
+        self,
+        path=f"{DATA_PATH}/cache/router_cache.json",
+        max_size=DEFAULT_ROUTER_CACHE_SIZE,
+        ttl=DEFAULT_ROUTER_CACHE_TTL,
+        fuzzy_threshold=DEFAULT_ROUTER_CACHE_FUZZY_THRESHOLD,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fuzzy_threshold = fuzzy_threshold
+        # 规范化的请求 -> {"time": 写入时间, "subtasks": 子任务列表}，按最近使用排序
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self._loaded = False
+
+    @staticmethod
+    def normalize(request: str) -> str:
+        """忽略大小写、空白和标点."""
+        return "".join(
+            ch
+            for ch in request.lower()
+            if not ch.isspace() and not unicodedata.category(ch).startswith("P")
+        )
+
+    def _fresh(self, entry: dict) -> bool:
+        return time.time() - entry["time"] < self.ttl
+
+    def get(self, request: str) -> list | None:
+        key = self.normalize(request)
+        entry = self.entries.get(key)
+        if entry is not None and self._fresh(entry):
+            self.entries.move_to_end(key)
+            return deepcopy(entry["subtasks"])
+
+        if self.fuzzy_threshold >= 1.0:
+            return None
+        # 模糊匹配只复用单个子任务的分解结果（即任务类型），子任务内容替换为本次请求
+        best, best_ratio = None, self.fuzzy_threshold
+        for cached_key, cached in self.entries.items():
+            if len(cached["subtasks"]) != 1 or not self._fresh(cached):
+                continue
+            matcher = difflib.SequenceMatcher(None, key, cached_key)
+            if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = cached, ratio
+        if best is None:
+            return None
+        subtask = dict(best["subtasks"][0], content=request, dependency=[])
+        _logger.info(f"Router cache fuzzy hit ({best_ratio:.2f}): {request}")
+        return [subtask]
+
+    def put(self, request: str, subtasks: list):
+        self.entries[self.normalize(request)] = {"time": time.time(), "subtasks": subtasks}
+        self.entries.move_to_end(self.normalize(request))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as ex:
+            _logger.error(f"Fail to load router cache: {ex!r}")
+            return
+        for key, entry in entries.items():
+            if self._fresh(entry):
+                self.entries[key] = entry
+
+    def save(self, data: str):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    async def async_get(self, request: str) -> list | None:
+        if not self._loaded:
+            await asyncio.get_running_loop().run_in_executor(None, self.load)
+        return self.get(request)
+
+    async def async_put(self, request: str, subtasks: list):
+        self.put(request, subtasks)
+        data = json.dumps(self.entries, ensure_ascii=False)  # 在事件循环中生成快照，写文件放到执行器中
+        await asyncio.get_running_loop().run_in_executor(None, self.save, data)
+
+
 class Router(Action):
     def __init__(self, name="Manager", context=None):
         super().__init__(name, context)
         self.llm = LLM()
+        self.cache = DecompositionCache()
 
     async def run(self, user_request: str) -> list:
+        cached = await self.cache.async_get(user_request)
+        if cached is not None:
+            _logger.info(f"Router cache hit: {user_request}")
+            return cached
+
         self.llm.add_system_msg(SYSTEM_MESSAGE)
         self.llm.add_user_msg(USER_MESSAGE.format(user_request=user_request))
-        loop = asyncio.get_running_loop()
-        rsp = await loop.run_in_executor(
-            None, self.llm.chat_completion_text_v1, self.llm.history
-        )
+        rsp = await self.llm.async_chat_completion_text_v1(self.llm.get_messages())
         _logger.info(f"Router response: {rsp}")
-        self.llm.reset()
-
-        rsp_list = self.parse_output(rsp)
+        try:
+            rsp, rsp_list = await self._parse_with_reask(rsp, self.parse_output)
+        finally:
+            self.llm.reset()
         print("Router.run():\n" + rsp)
+        subtasks = [task for task in rsp_list if "id" in task]  # 不缓存COT
+        if subtasks:
+            await self.cache.async_put(user_request, deepcopy(subtasks))
         return rsp_list
 
-    def parse_output(self, output: str) -> dict:
-        """将LLM的输出转换为JSON字符串."""
-        # TODO error handling
-        if output.startswith("```json"):
-            output = output[7:]
-            output = output[:-3]
-            return json.loads(output.strip())
-        if output.startswith("```"):
-            output = output[3:]
-            output = output[:-3]
-            return json.loads(output.strip())
-        output = output.replace("}{", "},{")
-        return json.loads(output.strip())
+    def parse_output(self, output: str) -> list:
+        """将LLM的输出转换为子任务列表（第一项可能是COT）."""
+        rsp_list = parse_json(output, list)
+        for task in rsp_list:
+            if not isinstance(task, dict):
+                raise ParseError("数组中的每一项都必须是JSON对象")
+            if "id" in task:
+                require_keys(task, ("type", "content"))
+        if not any("id" in task for task in rsp_list):
+            raise ParseError("没有分解出任何子任务")
+        return rsp_list
 
     def reset(self):
         self.llm.reset()
@@ -1,12 +1,24 @@
+import asyncio
+import time
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import datetime, timedelta
-from queue import Queue
 
 from .Router import Router
-from .environment import Environment
+from .const import (
+    DEFAULT_MAX_CONCURRENT_SESSIONS,
+    DEFAULT_MAX_SESSIONS,
+    DEFAULT_SESSION_IDLE_TIMEOUT,
+)
+from .environment import Environment, TurnStats
+from .intent_matcher import match_intent
 from .message import Message
+from .prefetch import PREFETCH, start_prefetch
+from .stream import RESPONSE_STREAM, STREAM_FINISH
 from .utils.singleton import Singleton
 from .Synthesizer import Synthesizer
+from .translator import Translator
+from .utils.logs import _logger
 
 
 class Subtask:
@@ -22,184 +34,315 @@ class Subtask:
         return f"Subtask:id={self.id}, content={self.content}, type={self.type}, dependency={self.dependency!s}, finish_time={self.finsih_time}"
 
 
-class Supervisor(metaclass=Singleton):
+# 子任务类型 -> 负责执行该类子任务的角色
+SUBTASK_ROLES = {
+    "TAP generation": "TAPGenerator",
+    "Device Control": "DeviceControler",
+    "General Q&A": "Chatbot",
+}
+
+
+class PendingSubtask:
+    """因AskUser而暂停、等待用户回复的子任务，保留其运行环境以便继续执行."""
+
+    def __init__(self, subtask: Subtask, environment: Environment, msg: Message):
+        self.subtask = subtask
+        self.environment = environment
+        self.last_message_from = msg.role  # 用户的回复要发给这个角色
+        self.question = msg.content
+
+
+class Supervisor:
     def __init__(self):
-        self.environment = Environment()
-        self.flag = True
-        self.last_message_from = None
-        self.task_que: Queue[Subtask] = Queue()  # 等待完成的子任务队列
-        self.rspls: list = []  # 用于汇总所有已经完成的子任务的最后返回信息的content
-        self.subtask_done: list[Subtask] = []  # 用于存储所有已经完成的子任务的列表
-        self.subtask_todo: list[Subtask] = []  # 用于存储所有等待完成的子任务的列表
-        self.curr_subtask: Subtask | None = None
+        self.subtask_todo: dict[int, Subtask] = {}  # 尚未开始执行的子任务，id -> Subtask
+        self.subtask_done: dict[int, Subtask] = {}  # 已经完成的子任务，id -> Subtask
+        self.waiting: list[PendingSubtask] = []  # 正在等待用户回复的子任务
+        self.rspls: dict[int, str] = {}  # 已经完成的子任务的最后返回信息，id -> content
+        self.total_subtasks = 0  # 本次请求分解得到的子任务总数
+        self._idle_envs: list[Environment] = []  # 可复用的空闲环境，每个运行中的子任务独占一个环境
+        # 最近一次请求中各子任务的调度统计，子任务id -> TurnStats；环境释放时会清空其统计，因此在此保留
+        self.last_turn_stats: dict[int, TurnStats] = {}
         self.router = Router()
         self.synthesizer = Synthesizer()
 
     async def task_decomposition(self, request):
-        """当且仅当子任务队列为空且self.flag为True时调用此方法,分解复杂任务,将子任务加入子任务队列."""
-        print("Run task decomposition")
+        """分解用户请求，将子任务加入subtask_todo，执行顺序由子任务之间的依赖关系决定."""
+        _logger.info("Run task decomposition")
         rsp_list = await self.router.run(request)  # 返回分解任务后的子任务list
         for task in rsp_list:
             if "id" not in task:
                 continue
-            newSubtask = Subtask(
+            subtask = Subtask(
                 id=task["id"],
                 content=task["content"],
-                type=task["type"],
-                dependency=task["dependency"],
+                type=task["type"].strip(),
+                dependency=task.get("dependency", []),
             )
-            # 目前采用队列的FIFO方式决定任务执行顺序，每次执行子任务时，从队列中取出一个子任务，执行完毕后再取下一个
-            self.task_que.put(newSubtask)
-            # subtask_todo是为了生成DAG图，执行任务过程中不需要更新
-            self.subtask_todo.append(newSubtask)
-            # TODO 拓扑排序
-
-    async def process(self, request: str):
-        if self.task_que.empty() and self.flag:
-            # 子任务队列为空且所有子任务都已经完成
-            await self.task_decomposition(request)
+            self.subtask_todo[subtask.id] = subtask
+        self.total_subtasks = len(self.subtask_todo)
 
-        if self.flag:  # 如果flag为True，说明上一个子任务已经完成，需要执行新的子任务
-            subtask: Subtask = self.task_que.get(block=False)  # 获取新任务
-            self.curr_subtask = subtask
-            print(f"Execute new subtask: {subtask.content}")
-
-            dep: list[int] = subtask.dependency
-            if len(dep) > 0:
-                # 当subtask.dependecny非空时，说明该任务有依赖任务信息
-                dep_info: str = ""
-                for index in dep:
-                    content = self.subtask_done[index - 1].content
-                    finish_time = self.subtask_done[index - 1].finsih_time
-                    finish_info = self.subtask_done[index - 1].finish_msg
-                    dep_info += f"Subtask {index}: {content}, finish time: {finish_time}, finish info: {finish_info}\n"
-                dep_info_message = Message(
-                    role="Supervisor",
-                    content=dep_info,
-                    cause_by="Dependency_information",
-                    sent_from="User",
-                    send_to=[],
-                )
-                print("dependency_information: ", dep_info_message.to_Str())
-            else:
-                dep_info_message = None
-
-            if subtask.type == "TAP generation":
-                if dep_info_message is not None:
-                    dep_info_message.send_to.append("TAPGenerator")
-                await self.environment.publish_message(
-                    Message(
-                        role="Supervisor",
-                        content=subtask.content,
-                        send_to=["TAPGenerator"],
-                        sent_from="User",
-                        cause_by="UserInput",
-                        attachment=dep_info_message,
-                    )
-                )
-
-            elif subtask.type == "Device Control":
-                if dep_info_message is not None:
-                    dep_info_message.send_to.append("DeviceControler")
-                await self.environment.publish_message(
-                    Message(
-                        role="Supervisor",
-                        content=subtask.content,
-                        send_to=["DeviceControler"],
-                        sent_from="User",
-                        cause_by="UserInput",
-                        attachment=dep_info_message,
-                    )
-                )
-
-            elif subtask.type == "General Q&A":
-                if dep_info_message is not None:
-                    dep_info_message.send_to.append("Chatbot")
-                await self.environment.publish_message(
-                    Message(
-                        role="Supervisor",
-                        content=subtask.content,
-                        send_to=["Chatbot"],
-                        sent_from="User",
-                        cause_by="UserInput",
-                        attachment=dep_info_message,
-                    )
-                )
-            else:
-                raise Exception("Unknown subtask type")
-
-        else:  # 如果flag为False，说明上一个子任务还未完成，正在等待用户回复，所以需要将用户回复发送给上一个子任务的角色
-            if self.last_message_from is None:
-                raise Exception("last_message_from is None")
-            await self.environment.publish_message(
-                Message(
-                    role="Supervisor",
-                    content=request,
-                    send_to=[self.last_message_from],
-                    sent_from="User",
-                    cause_by="UserResponse",
-                )
+    def _ready_subtasks(self) -> list[Subtask]:
+        """返回所有依赖都已完成的子任务（拓扑排序中入度为0的节点）."""
+        known = self.subtask_todo.keys() | {p.subtask.id for p in self.waiting}
+        ready = [
+            subtask
+            for subtask in self.subtask_todo.values()
+            if all(
+                dep in self.subtask_done or dep not in known
+                for dep in subtask.dependency
             )
+        ]
+        if not ready and self.subtask_todo and not self.waiting:
+            # 依赖关系中存在环：按id顺序执行第一个子任务以打破循环
+            subtask = self.subtask_todo[min(self.subtask_todo)]
+            _logger.warning(f"Cyclic dependency detected, force to run: {subtask.toStr()}")
+            ready = [subtask]
+        return sorted(ready, key=lambda subtask: subtask.id)
+
+    def _dependency_message(self, subtask: Subtask) -> Message | None:
+        """按id汇总子任务所依赖的已完成子任务的信息."""
+        dep_info = ""
+        for dep in subtask.dependency:
+            done = self.subtask_done.get(dep)
+            if done is None:
+                continue
+            dep_info += f"Subtask {dep}: {done.content}, finish time: {done.finsih_time}, finish info: {done.finish_msg}\n"
+        if not dep_info:
+            return None
+        _logger.info(f"dependency_information: {dep_info}")
+        return Message(
+            role="Supervisor",
+            content=dep_info,
+            cause_by="Dependency_information",
+            sent_from="User",
+            send_to=[],
+        )
+
+    def _acquire_env(self) -> Environment:
+        if self._idle_envs:
+            return self._idle_envs.pop()
+        return Environment()
+
+    def _release_env(self, environment: Environment):
+        environment.reset()
+        self._idle_envs.append(environment)
+
+    async def _execute(self, subtask: Subtask, concurrent: bool):
+        """在独占的环境中执行一个子任务."""
+        if concurrent:
+            # 多个子任务并行执行时不流式推送，避免不同子任务的回复交错
+            RESPONSE_STREAM.set(None)
+        STREAM_FINISH.set(self.total_subtasks == 1)
+        _logger.info(f"Execute new subtask: {subtask.toStr()}")
+
+        role = SUBTASK_ROLES.get(subtask.type)
+        if role is None:
+            raise Exception(f"Unknown subtask type: {subtask.type}")
+        dep_info_message = self._dependency_message(subtask)
+        if dep_info_message is not None:
+            dep_info_message.send_to.append(role)
+
+        environment = self._acquire_env()
+        await environment.publish_message(
+            Message(
+                role="Supervisor",
+                content=subtask.content,
+                send_to=[role],
+                sent_from="User",
+                cause_by="UserInput",
+                attachment=dep_info_message,
+            )
+        )
+        await self._run_env(subtask, environment)
+
+    async def _resume(self, pending: PendingSubtask, request: str):
+        """将用户的回复发送给等待中的子任务，并继续执行."""
+        STREAM_FINISH.set(self.total_subtasks == 1)
+        await pending.environment.publish_message(
+            Message(
+                role="Supervisor",
+                content=request,
+                send_to=[pending.last_message_from],
+                sent_from="User",
+                cause_by="UserResponse",
+            )
+        )
+        await self._run_env(pending.subtask, pending.environment)
+
+    async def _run_env(self, subtask: Subtask, environment: Environment):
+        msg, flag = await environment.run()
+        self.last_turn_stats[subtask.id] = environment.last_turn_stats
+
+        if not flag:
+            # resp_type是AskUser，子任务暂停，等待用户回复
+            self.waiting.append(PendingSubtask(subtask, environment, msg))
+            return
+
+        # resp_type是Finish（或环境运行出错），子任务结束
+        content = msg.content if isinstance(msg, Message) else msg
+        self.rspls[subtask.id] = f"subtask {subtask.id}:{content}"
 
-        msg, flag = await self.environment.run()
-
-        if flag:  # 如果环境运行得到的信息中的flag是True，说明resp_type是Finish，本次任务已经完成，需要重置环境
-            self.flag = True
-            self.last_message_from = None
-            self.environment.reset()
-
-            self.rspls.append(
-                f"subtask {self.curr_subtask.id}:{msg.content}"
-            )  # 将本次任务的返回信息加入rspls
-
-            now = datetime.now() + timedelta(hours=8)  # 正式发布时可能需要修改时区
-            formatted_time = now.strftime("%Y-%m-%d %H:%M:%S")  # 该任务完成的格式化时间
-
-            curr_subtask: Subtask = deepcopy(self.curr_subtask)
-            curr_subtask.finsih_time = formatted_time
-            curr_subtask.finish_msg = msg
-            self.subtask_done.append(curr_subtask)  # 该子任务已经完成，加入subtask_done
-
-            print(f"{self.curr_subtask.content} done.")
-            print("self.subtask_done(Supervisor.py, line 119):")
-            for st in self.subtask_done:
-                print(st.toStr())
-            if self.task_que.empty():  # 所有子任务都已经处理完毕
-                print("All subtasks done.")
-                rsp = deepcopy(self.rspls)
-
-                # 根据是否有多个子任务的返回信息，决定是否需要合成返回信息
-                if len(rsp) == 1:
-                    final_rsp = rsp[0].split(":", 1)[1]
-                else:
-                    final_rsp = await self.synthesizer.run(rsp)
-
-                self.rspls.clear()
-                self.subtask_done.clear()
-                self.subtask_todo.clear()
-
-                return final_rsp
-            return None  # 如果返回None，说明还有子任务需要处理
-
-        # 如果环境运行得到的信息中的flag是False，说明resp_type是AskUser，本次任务还未完成，需要继续
-        self.flag = False
-        self.last_message_from = (
-            msg.role
-        )  # msg.role记录了上一次信息是由哪个角色发出的，下一次信息要发给这个角色
-        return msg.content
+        now = datetime.now() + timedelta(hours=8)  # 正式发布时可能需要修改时区
+        done: Subtask = deepcopy(subtask)
+        done.finsih_time = now.strftime("%Y-%m-%d %H:%M:%S")  # 该任务完成的格式化时间
+        done.finish_msg = msg
+        self.subtask_done[subtask.id] = done
+        _logger.info(f"{done.toStr()} done.")
+        self._release_env(environment)
+
+    async def _fast_path(self, request: str) -> str | None:
+        """简单的单设备命令在本地匹配后直接执行，匹配不确定或执行失败时返回None."""
+        match = match_intent(request)
+        if match is None:
+            return None
+        try:
+            await Translator().run_commands(match.commands)
+        except Exception as ex:
+            _logger.warning(f"Fast path failed, fall back to LLM: {ex!r}")
+            return None
+        stream = RESPONSE_STREAM.get()
+        if stream is not None:
+            stream.emit(match.say_to_user)
+        return match.say_to_user
+
+    async def process(self, request: str) -> str:
+        self.last_turn_stats = {}
+        if self.waiting:
+            # 有子任务正在等待用户回复，将用户回复发送给该子任务
+            start_prefetch(request)
+            await self._resume(self.waiting.pop(0), request)
+        else:
+            rsp = await self._fast_path(request)
+            if rsp is not None:
+                return rsp
+            # 天气等无需参数的工具与Router分解任务同时调用
+            start_prefetch(request)
+            await self.task_decomposition(request)
+
+        while not self.waiting:
+            ready = self._ready_subtasks()
+            if not ready:
+                break
+            for subtask in ready:
+                self.subtask_todo.pop(subtask.id)
+            # 所有依赖已满足的子任务并行执行
+            tasks = [
+                asyncio.create_task(self._execute(subtask, len(ready) > 1)) for subtask in ready
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # 某个子任务出错（或本轮被取消）时，取消其余子任务并等待其结束，再向上抛出
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.waiting:
+            # 有子任务需要询问用户，本轮先返回问题，其余子任务在用户回复后继续执行
+            return self.waiting[0].question
+
+        _logger.info("All subtasks done.")
+        rsp = [self.rspls[id] for id in sorted(self.rspls)]
+        self.reset()
+        if not rsp:
+            return "Error: failed to decompose the request, please try again."
+        # 根据是否有多个子任务的返回信息，决定是否需要合成返回信息
+        if len(rsp) == 1:
+            return rsp[0].split(":", 1)[1]
+        return await self.synthesizer.run(rsp)
+
+    def reset(self):
+        """清空本次请求的所有子任务状态."""
+        for pending in self.waiting:
+            self._release_env(pending.environment)
+        self.subtask_todo.clear()
+        self.subtask_done.clear()
+        self.waiting.clear()
+        self.rspls.clear()
+        self.total_subtasks = 0
 
     async def run(self, request: str):  # noqa: D102
         # request 即 conversation[-1]["message"], 用户输入
-        rsp = await self.process(request)
-        while rsp is None:
+        try:
             rsp = await self.process(request)
-        if isinstance(rsp, list):
-            return "\n".join(
-                f"Subtask {i} response: {msg}" for i, msg in enumerate(rsp)
-            )
+        except Exception:
+            self.reset()  # 出错时丢弃本次请求的状态，避免影响该会话的后续请求
+            raise
+        finally:
+            # 预取的结果只在本次请求中有效
+            prefetch = PREFETCH.get()
+            if prefetch is not None:
+                prefetch.cancel()
+                PREFETCH.set(None)
         if isinstance(rsp, str):
             return rsp
         return "Error: illegal response type."
 
 
-SUPERVISOR = Supervisor()
+class Session:
+    """一个对话（conversation_id）对应的会话，拥有独立的Supervisor（及其环境、角色和子任务队列）."""
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.supervisor = Supervisor()
+        self.lock = asyncio.Lock()  # 同一会话内的请求按顺序处理
+        self.pending = 0  # 正在处理或等待处理的请求数，大于0时会话不会被淘汰
+        self.last_active = time.monotonic()
+
+    @property
+    def busy(self) -> bool:
+        return self.pending > 0 or self.lock.locked()
+
+
+class SupervisorManager(metaclass=Singleton):
+    """按conversation_id管理Supervisor会话，不同会话之间可以并行处理请求."""
+
+    def __init__(
+        self,
+        max_sessions=DEFAULT_MAX_SESSIONS,
+        idle_timeout=DEFAULT_SESSION_IDLE_TIMEOUT,
+        max_concurrency=DEFAULT_MAX_CONCURRENT_SESSIONS,
+    ):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions: OrderedDict[str, Session] = OrderedDict()  # 按最近使用排序
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    def get_session(self, conversation_id: str) -> Session:
+        """获取会话，不存在时创建，并将其标记为最近使用."""
+        session = self.sessions.get(conversation_id)
+        if session is None:
+            self._evict()
+            session = Session(conversation_id)
+            self.sessions[conversation_id] = session
+            _logger.info(f"Create session {conversation_id}, total: {len(self.sessions)}")
+        self.sessions.move_to_end(conversation_id)
+        session.last_active = time.monotonic()
+        return session
+
+    def _evict(self):
+        """淘汰空闲超时的会话；会话数仍达到上限时，按LRU顺序淘汰空闲会话."""
+        now = time.monotonic()
+        for conversation_id, session in list(self.sessions.items()):
+            if session.busy:
+                continue
+            if (
+                now - session.last_active > self.idle_timeout
+                or len(self.sessions) >= self.max_sessions
+            ):
+                self.sessions.pop(conversation_id)
+                _logger.info(f"Evict session {conversation_id}")
+
+    async def run(self, conversation_id: str, request: str):
+        session = self.get_session(conversation_id)
+        # 在等待锁和并发名额之前就标记为忙碌，避免等待中的会话（及其AskUser状态）被淘汰
+        session.pending += 1
+        try:
+            async with session.lock, self.semaphore:
+                return await session.supervisor.run(request)
+        finally:
+            session.pending -= 1
+            session.last_active = time.monotonic()
+
+
+SUPERVISOR_MANAGER = SupervisorManager()
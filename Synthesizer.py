@@ -1,9 +1,7 @@
-import asyncio  # noqa: D100
-import json
-
-from .actions.action import Action
+from .actions.action import Action  # noqa: D100
 from .llm import LLM
 from .utils.logs import _logger
+from .utils.parser import parse_json, require_keys
 
 SYSTEM_MESSAGE = """
 # Role
@@ -40,30 +38,19 @@ class Synthesizer(Action):
     async def run(self, user_request: str) -> list:
         self.llm.add_system_msg(SYSTEM_MESSAGE)
         self.llm.add_user_msg(USER_MESSAGE.format(user_request=user_request))
-        loop = asyncio.get_running_loop()
-        rsp = await loop.run_in_executor(
-            None, self.llm.chat_completion_text_v1, self.llm.history
-        )
+        # Synthesizer的输出总是最终回复，流式推送其中的content字段
+        rsp = await self._ask_llm(field="content", gated=False)
         _logger.info(f"Synthesizer response: {rsp}")
-        self.llm.reset()
-
-        rsp_json = self.parse_output(rsp)
+        try:
+            rsp, rsp_json = await self._parse_with_reask(rsp, self.parse_output)
+        finally:
+            self.llm.reset()
         print("Synthesizer.run():\n" + rsp)
         return rsp_json["content"]
 
     def parse_output(self, output: str) -> dict:
-        """将LLM的输出转换为JSON字符串."""
-        # TODO error handling
-        if output.startswith("```json"):
-            output = output[7:]
-            output = output[:-3]
-            return json.loads(output.strip())
-        if output.startswith("```"):
-            output = output[3:]
-            output = output[:-3]
-            return json.loads(output.strip())
-        output = output.replace("}{", "},{")
-        return json.loads(output.strip())
+        """将LLM的输出转换为JSON，并检查content字段."""
+        return require_keys(parse_json(output, dict), ("content",))
 
     def reset(self):
         self.llm.reset()
@@ -1,7 +1,20 @@
+import asyncio
 from abc import ABC, abstractmethod
+from collections.abc import Callable
+from typing import Any
+from ..prefetch import get_prefetched
 from ..utils.logs import _logger
+from ..utils.parser import ParseError
+from ..stream import RESPONSE_STREAM, STREAM_FINISH, JsonFieldStreamer
 from ..tool_agent import tool_agent
 
+FORMAT_ERROR_MESSAGE = """
+你的上一条回复无法解析：{error}
+请按照要求的格式重新输出完整的回复，只输出JSON，不要包含其他内容。
+"""
+
+MAX_FORMAT_RETRIES = 2  # 回复无法解析时请LLM重新输出的最大次数
+
 
 class Action(ABC):
     def __init__(self, name="", context=None):
@@ -38,6 +51,100 @@ class Action(ABC):
             "The reset method should be implemented in a subclass."
         )
 
+    async def _ask_llm(
+        self, json_mode=False, field="Say_to_user", gated=True, streaming=True
+    ) -> str:
+        """用self.llm的对话历史请求LLM.
+
+        若当前请求开启了流式输出，则边生成边将回复中的field字段推送给用户。
+        gated为True时，只推送AskUser的回复，以及作为最终回复的Finish的回复。
+        streaming为False时不推送（例如修正已经推送过的回复）。
+        """
+        stream = RESPONSE_STREAM.get() if streaming else None
+        if stream is None:
+            if json_mode:
+                return await self.llm.async_chat_completion_json_v1(self.llm.get_messages())
+            return await self.llm.async_chat_completion_text_v1(self.llm.get_messages())
+
+        actions = None
+        if gated:
+            actions = {"AskUser", "Finish"} if STREAM_FINISH.get() else {"AskUser"}
+        streamer = JsonFieldStreamer(stream, field, actions)
+        return await self.llm.async_chat_completion_stream_v1(
+            self.llm.get_messages(), on_text=streamer.feed, json_mode=json_mode
+        )
+
+    async def _parse_with_reask(
+        self, rsp: str, parse: Callable[[str], Any]
+    ) -> tuple[str, Any]:
+        """解析LLM的回复，失败时将错误信息发给LLM，只请它重新输出格式正确的回复.
+
+        重新输出的请求和格式错误的回复都不加入history，返回(可以解析的回复, 解析结果)。
+        """
+        for _ in range(MAX_FORMAT_RETRIES):
+            try:
+                return rsp, parse(rsp)
+            except ParseError as ex:
+                _logger.warning(f"{self.name} output can't be parsed ({ex}): {rsp}")
+                messages = [
+                    *self.llm.get_messages(),
+                    {"role": "assistant", "content": rsp},
+                    {"role": "user", "content": FORMAT_ERROR_MESSAGE.format(error=ex)},
+                ]
+                rsp = await self.llm.async_chat_completion_text_v1(messages)
+        return rsp, parse(rsp)
+
+    def parse_tool_calls(self, rsp_json: dict) -> list[tuple[str, Any]]:
+        """从CallTools回复中取出要调用的工具，返回[(工具名称, 参数)].
+
+        Tools为多个工具调用的列表；也兼容只调用一个工具的Target_tool/Arguments写法。
+        """
+        if "Tools" not in rsp_json:
+            if "Target_tool" not in rsp_json:
+                raise ParseError("缺少字段：Tools")
+            return [(str(rsp_json["Target_tool"]).strip(), rsp_json.get("Arguments", ""))]
+        tools = rsp_json["Tools"]
+        if isinstance(tools, dict):
+            tools = [tools]
+        if not isinstance(tools, list) or not tools:
+            raise ParseError("Tools应为非空的数组")
+        calls = []
+        for tool in tools:
+            if not isinstance(tool, dict) or "Target_tool" not in tool:
+                raise ParseError("Tools中的每一项都必须包含Target_tool")
+            calls.append((str(tool["Target_tool"]).strip(), tool.get("Arguments", "")))
+        return calls
+
+    async def call_tools(self, calls: list[tuple[str, Any]]) -> tuple[str, str]:
+        """并发调用多个工具，将所有返回信息合并为一条观察，返回(观察内容, 发送者).
+
+        只调用一个工具时，观察内容与发送者与原来逐个调用时相同；工具不存在或调用出错时，
+        对应的返回信息中说明原因，不影响其他工具。
+        """
+
+        async def call(target_tool, arguments):
+            if target_tool not in self.tool_dict:
+                return f"no available tool named {target_tool}"
+            prefetched = await get_prefetched(target_tool, arguments)
+            if prefetched is not None:
+                return prefetched
+            try:
+                return f"{await self.tool_dict[target_tool].run(arguments)}"
+            except Exception as ex:  # noqa: BLE001
+                _logger.warning(f"Tool {target_tool} failed: {ex!r}")
+                return f"Error: {target_tool} failed: {ex!r}"
+
+        results = await asyncio.gather(*(call(*c) for c in calls))
+        known = [target_tool for target_tool, _ in calls if target_tool in self.tool_dict]
+        sent_from = ",".join(dict.fromkeys(known)) or "SYSTEM"
+        if len(calls) == 1:
+            return f"Observation:{results[0]}", sent_from
+        observations = "\n".join(
+            f"[{target_tool}] {result}"
+            for (target_tool, _), result in zip(calls, results)
+        )
+        return f"Observation:\n{observations}", sent_from
+
     def tool_agent_to_tool_list(self) -> list:
         """将action中的tool_agent列表转换为llm可识别的tool_list."""
         return [
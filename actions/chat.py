@@ -1,11 +1,11 @@
 from ..actions.action import Action
-from ..configs import CONFIG
+from ..catalog import encode_catalog
+from ..context_assistant import get_related_context, get_related_sensor_data
 from ..message import Message
 from ..utils.logs import _logger
-from ..llm import LLM
-import json
+from ..utils.parser import ParseError, parse_action
+from ..llm import LLM, summarize_observation
 from ..tool_agent import time_tool_agent, weather_tool_agent, map_tool_agent
-import asyncio
 
 SYSTEM_MESSAGE = """
 # Role
@@ -14,8 +14,8 @@ SYSTEM_MESSAGE = """
 
 # Input
 用户需求（User Request）
-工具列表 （Tool list）：一个列表，记录了可用的工具，包括工具的名称（name）、功能（function）、必须的参数（arguments）
-设备列表（Device list)：家中可用的设备信息
+工具列表 （Tool list）：一个列表，记录了可用的工具，包括工具的名称（name）、功能（function）、必须的参数（arguments），见本提示词末尾
+设备列表（Device list)：家中可用的设备信息。设备列表采用紧凑格式：每个设备一行（id|name|area|type），其下缩进的每一行是一个属性（service.property|format|access|range|unit|description），access中r、w、n分别表示可读、可写、可通知，range为取值范围min..max/step或取值列表value=description。
 传感器数据（Data from sensors）：当前所有家中可用的设备上安装的传感器的数据。每组传感器信息都有一个与设备ID匹配的ID。
 
 # Solution
@@ -25,10 +25,10 @@ SYSTEM_MESSAGE = """
 2. **AskUser**
 当用户提出的问题不够清晰明确，你不能准确理解**问题本身**，你将询问用户以获得更多问题细节，直到你能回答该问题。
 3. **CallTools**
-当基于你已有的知识或提供给你的传感器数据不足以回答用户的问题，你可以选择调用工具列表中的一个工具，观察工具的返回结果，并结合返回结果继续采取行动。
+当基于你已有的知识或提供给你的传感器数据不足以回答用户的问题，你可以选择调用工具列表中的工具（一次可以同时调用多个工具），观察工具的返回结果，并结合返回结果继续采取行动。
 
 # 特别注意
-1. 每一次行动，你只能**调用1种工具**，如果你需要多个工具的返回结果，你将分多次调用工具。
+1. 如果你需要多个工具的返回结果，应在**一次**CallTools中同时调用所有互不依赖的工具；只有当一个工具的参数依赖另一个工具的返回结果时，才分多次调用。
 2. 当用户请求中包含多个问题时，你需要确保能够回答所有问题后，**一次性输出**所有问题的答案。
 3. 当用户询问有关你的信息时，你需要站在整个智能家居系统的角度回答用户的问题，而不是站在你自己的角度回答。具体来说，你需要介绍自己是DomusGPT，是智能家居系统的控制核心。
 
@@ -52,26 +52,26 @@ SYSTEM_MESSAGE = """
 {
     "Action_type": "CallTools",
     "Thought": <你输出此内容的推理过程>,
-    "Arguments": <输入工具的参数>,
-    "Target_tool": <准确的工具名称>,
+    "Tools": [{"Target_tool": <准确的工具名称>, "Arguments": <输入工具的参数>}, ...],
 }
 
 # Example:
 Example1:
-User Input: 请告诉我今天的天气状况？
-tool list:[{"name": "WeatherInformation", "function": "提供用户家附近的天气信息/气象数据", arguments:[]}]
+User Input: 现在几点了？今天的天气状况怎么样？
+tool list:[{"name": "WeatherInformation", "function": "提供用户家附近的天气信息/气象数据", arguments:[]}, {"name": "Time", "function": "提供当前的日期和时间", arguments:[]}]
 Chatbot:
 {
     "Action_type": "CallTools",
-    "Thought": "用户需要获取今天的天气信息，我可以通过调用WeatherInformation这个工具来获得天气信息。",
-    "Arguments": [],
-    "Target_tool": "WeatherInformation",
+    "Thought": "用户需要获取当前时间和今天的天气信息，这两个工具互不依赖，我可以同时调用Time和WeatherInformation。",
+    "Tools": [{"Target_tool": "Time", "Arguments": []}, {"Target_tool": "WeatherInformation", "Arguments": []}],
 }
-Observation: “用户家所在区域今日的气象信息是：<省略具体的气象信息>”
+Observation:
+[Time] current time:<省略具体的时间>
+[WeatherInformation] 用户家所在区域今日的气象信息是：<省略具体的气象信息>
 {
     "Action_type": "Finish",
-    "Thought": "结合工具的返回信息，我已经获得了今日的天气信息，我可以回答用户提出的问题",
-    "Say_to_user": "今日的天气信息是：<省略具体的气象信息>",
+    "Thought": "结合工具的返回信息，我已经获得了当前时间和今日的天气信息，我可以回答用户提出的问题",
+    "Say_to_user": "现在是<省略具体的时间>，今日的天气信息是：<省略具体的气象信息>",
 }
 
 Example2:
@@ -86,11 +86,24 @@ Chatbot:
 # 请注意：你的回答必须和用户输入（User request）是同一种语言，例如：中文、英文等。
 """
 
+# 工具列表不随请求变化，放在系统提示词末尾，使提示词前缀在每次请求中保持一致，便于服务商缓存
+TOOL_LIST_MESSAGE = """
+# Tool list
+{tool_list}
+"""
+
+# 按变化频率从低到高排列，用户请求放在最后
 USER_MESSAGE = """
-User request: {user_request}
-Tool list: {tool_list}
 Device list: {device_list}
 Data from sensors: {sensor_data}
+User request: {user_request}
+"""
+
+# 较早的用户消息不再重复发送设备列表和传感器数据，最新的用户消息中总是包含完整的内容
+USER_SUMMARY_MESSAGE = """
+Device list: （见最新的用户消息）
+Data from sensors: （见最新的用户消息）
+User request: {user_request}
 """
 
 TOOL_MESSAGE = """
@@ -98,6 +111,14 @@ Tool return information: {tool_return}
 """
 
 
+# 每种Action_type的回复必须包含的字段
+ACTION_SCHEMAS = {
+    "Finish": ("Say_to_user",),
+    "AskUser": ("Say_to_user",),
+    "CallTools": (),  # Tools（或单个工具的Target_tool）由parse_tool_calls检查
+}
+
+
 class Chat(Action):
     def __init__(self, name="Chatbot", context=None):
         super().__init__(name, context)
@@ -105,59 +126,58 @@ class Chat(Action):
         self.tool_agent = [weather_tool_agent(), time_tool_agent(), map_tool_agent()]
         self.tool_list = self.tool_agent_to_tool_list()
         self.tool_dict = self.tool_agent_to_tool_dict()
+        self.request = ""  # 本次任务中用户的全部输入，用于筛选相关设备
 
     def parse_output(self, output: str) -> dict:
-        try:
-            # 如果输出以 "```json" 或 "```" 开头，移除这些标记
-            if output.startswith("```json"):
-                output = output[7:]
-                output = output[:-3]
-                return json.loads(output.strip())
-            elif output.startswith("```"):
-                output = output[3:]
-                output = output[:-3]
-                return json.loads(output.strip())
-            else:
-                # 尝试直接解析为JSON格式
-                return json.loads(output.strip())
-        except json.JSONDecodeError:
-            # 如果输出不是合法的JSON格式，包装成默认的JSON结构
-            return {
-                "Say_to_user": output,  # LLM的原始输出
-                "Action_type": "ContinueChat",  # 默认Action_type为ContinueChat
-                "Thought": "User wants to continue chatting.",  # 默认Thought内容
-            }
+        """将LLM的输出转换为JSON，并检查Action_type和必需的字段."""
+        rsp_json = parse_action(output, ACTION_SCHEMAS)
+        if rsp_json["Action_type"] == "CallTools":
+            self.parse_tool_calls(rsp_json)
+        return rsp_json
 
     async def run(self, history_msg: list[Message], user_input: Message) -> Message:
         _logger.info(f"Chat run: {user_input}")
         user_request = user_input.content
 
         if not self.llm.sysmsg_added:
-            self.llm.add_system_msg(SYSTEM_MESSAGE)
+            self.llm.add_system_msg(
+                SYSTEM_MESSAGE + TOOL_LIST_MESSAGE.format(tool_list=self.tool_list)
+            )
 
         if user_input.role == "Tool":
-            self.llm.add_user_msg(TOOL_MESSAGE.format(tool_return=user_request))
+            self.llm.add_user_msg(
+                TOOL_MESSAGE.format(tool_return=user_request),
+                summary=TOOL_MESSAGE.format(
+                    tool_return=summarize_observation(user_request)
+                ),
+                kind="tool",
+            )
         else:
+            self.request = f"{self.request}\n{user_request}".strip()
+            device_list = get_related_context(self.request)
             self.llm.add_user_msg(
                 USER_MESSAGE.format(
                     user_request=user_request,
-                    device_list=CONFIG.hass_data["all_context"],
-                    sensor_data=CONFIG.hass_data["all_sensor_data"],
-                    tool_list=self.tool_list,
-                )
+                    device_list=encode_catalog(device_list),
+                    sensor_data=get_related_sensor_data(device_list),
+                ),
+                summary=USER_SUMMARY_MESSAGE.format(user_request=user_request),
+                kind="context",
             )
 
-        loop = asyncio.get_running_loop()
-        rsp = await loop.run_in_executor(
-            None, self.llm.chat_completion_text_v1, self.llm.history
-        )
+        rsp = await self._ask_llm()
         _logger.info(f"Chat response: {rsp}")
         print(rsp)
-        rsp_json = self.parse_output(rsp)
+        try:
+            rsp, rsp_json = await self._parse_with_reask(rsp, self.parse_output)
+        except ParseError:
+            # 多次重新输出仍无法解析时，把原始输出当作对用户的回复
+            rsp_json = {"Action_type": "Finish", "Say_to_user": rsp}
         self.llm.add_assistant_msg(rsp)
         if rsp_json["Action_type"] == "Finish":
             # 结束任务，执行命令，返回信息发给用户（发布到环境中）
             self.llm.reset()
+            self.request = ""
             say_to_user = rsp_json["Say_to_user"]
             return Message(
                 role=self.name,
@@ -180,23 +200,14 @@ class Chat(Action):
 
         if rsp_json["Action_type"] == "CallTools":
             # 调用工具，工具返回的信息作为观察（observation）发回给自己
-            target_tool = rsp_json["Target_tool"]
-            arguments = rsp_json["Arguments"]
-            for tool in self.tool_list:
-                if tool["name"] == target_tool:
-                    # 调用tool
-                    tool_rsp = await self.tool_dict[target_tool].run(arguments)
-                    return Message(
-                        role="Tool",
-                        content="Observation:" + tool_rsp,
-                        sent_from=target_tool,
-                        send_to=["Chatbot"],
-                        cause_by="UserResponse",
-                    )
+            # 多个工具并发调用，所有返回信息合并为一条观察
+            observation, sent_from = await self.call_tools(
+                self.parse_tool_calls(rsp_json)
+            )
             return Message(
                 role="Tool",
-                content=f"Observation: no available tool named {target_tool}",
-                sent_from="SYSTEM",
+                content=observation,
+                sent_from=sent_from,
                 send_to=["Chatbot"],
                 cause_by="UserResponse",
             )
@@ -204,4 +215,5 @@ class Chat(Action):
 
     def reset(self):
         self.llm.reset()
+        self.request = ""
         _logger.info(f"{self.name} reset.")
@@ -1,11 +1,13 @@
-import asyncio  # noqa: D100, INP001
-import json
-import re
-
-from ..actions.action import Action  # noqa: TID252
-from ..configs import CONFIG  # noqa: TID252
-from ..llm import LLM  # noqa: TID252
+from ..actions.action import Action  # noqa: D100, INP001, TID252
+from ..catalog import encode_catalog  # noqa: TID252
+from ..context_assistant import (  # noqa: TID252
+    get_related_context,
+    get_related_sensor_data,
+)
+from ..llm import LLM, summarize_observation  # noqa: TID252
 from ..message import Message  # noqa: TID252
+from ..prefetch import prefetched_context  # noqa: TID252
+from ..stream import RESPONSE_STREAM  # noqa: TID252
 from ..tool_agent import (  # noqa: TID252
     map_tool_agent,
     time_tool_agent,
@@ -13,6 +15,7 @@ from ..tool_agent import (  # noqa: TID252
 )
 from ..translator import Translator  # noqa: TID252
 from ..utils.logs import _logger  # noqa: TID252
+from ..utils.parser import parse_action  # noqa: TID252
 
 SYSTEM_MESSAGE = """
 # Role
@@ -26,10 +29,11 @@ id.service.property = <value>
 
 # Input
 1. User request：用户请求。
-2. Device list：包含设备信息，包括ID、类型、区域和可用服务。每个服务都有特定的属性。
-3. Tool list：可用工具及其功能和所需参数。
+2. Device list：包含设备信息，包括ID、类型、区域和可用服务。每个服务都有特定的属性。设备列表采用紧凑格式：每个设备一行（id|name|area|type），其下缩进的每一行是一个属性（service.property|format|access|range|unit|description），access中r、w、n分别表示可读、可写、可通知，range为取值范围min..max/step或取值列表value=description。
+3. Tool list：可用工具及其功能和所需参数（见本提示词末尾）。
 4. Sensor data：所有附加到室内设备的传感器的当前数据。每组传感器信息的ID与其所属设备的ID匹配。
 5. Dependency task information：当前任务所依赖的任务信息。
+6. Prefetched information：已经预先获取的工具返回信息（例如WeatherInformation），格式为“工具名称: 返回信息”；其中已有的信息无需再调用对应的工具。
 
 # Solution
 1. 仅在能够充分判断所有前提条件的情况下，根据用户请求生成指令。
@@ -43,14 +47,14 @@ id.service.property = <value>
 # Action Types
 Finish：执行指令并向用户确认。
 AskUser：请求更多信息。
-CallTools：使用外部工具获取帮助。
+CallTools：使用外部工具获取帮助，一次可以同时调用多个工具。
 SeekHelp：仅在用户的请求不能立即执行时，向其他智能体请求帮助。
 
 # Output Format (In JSON type)
 AskUser：
 {"Action_type": "AskUser", "Thought": "请求用户输入的原因", "Say_to_user": "向用户的询问内容"}
 CallTools：
-{"Action_type": "CallTools", "Thought": "调用工具的原因", "Arguments": "所需参数", "Target_tool": "具体工具名称"}
+{"Action_type": "CallTools", "Thought": "调用工具的原因", "Tools": [{"Target_tool": "具体工具名称", "Arguments": "所需参数"}, ...]}
 Finish：
 {"Action_type": "Finish", "Thought": "采取行动的原因", "Commands": ["生成的指令"], "Say_to_user": "向用户的确认内容"}
 SeekHelp：
@@ -62,27 +66,17 @@ SeekHelp：
 DeviceControler：
 {
     "Action_type": "CallTools",
-    "Thought": "用户请求在 21:50 之前如果未到家且天气寒冷，则在 30 分钟后打开卧室空调。首先，我需要确定用户届时是否会晚归。",
-    "Arguments": "["school", "home", "driving"]",
-    "Target_tool": "PathPlanning"
-}
-观察结果：从用户的家到目的地驾车所需时间为：26.35分钟
-DeviceControler：
-{
-    "Action_type": "CallTools",
-    "Thought": "用户之前请求如果 21:50 还没到家且天气寒冷，则打开卧室空调。由于从学校到家的车程约为 26.35 分钟，我需要根据用户的出发时间计算实际到达时间，并与 21:50 进行比较。我还需要检查用户家附近的天气情况，以判断是否确实寒冷。",
-    "Arguments": "",
-    "Target_tool": "Time"
-}
-观察结果：当前时间是：2025-01-31 21:47:41
-DeviceControler：
-{
-    "Action_type": "CallTools",
-    "Thought": "为了判断室外是否寒冷，我需要调用 WeatherInformation 工具获取用户家位置的当前温度。",
-    "Arguments": "",
-    "Target_tool": "WeatherInformation"
+    "Thought": "用户请求在 21:50 之前如果未到家且天气寒冷，则在 30 分钟后打开卧室空调。我需要知道从学校到家的车程和当前时间，以判断用户届时是否会晚归，还需要获取用户家附近的天气情况，以判断是否确实寒冷。这三个工具互不依赖，可以同时调用。",
+    "Tools": [
+        {"Target_tool": "PathPlanning", "Arguments": ["school", "home", "driving"]},
+        {"Target_tool": "Time", "Arguments": ""},
+        {"Target_tool": "WeatherInformation", "Arguments": ""}
+    ]
 }
-观察结果：用户家所在区域的气象信息是<省略的具体气象信息>
+观察结果：
+[PathPlanning] 从用户的家到目的地驾车所需时间为：26.35分钟
+[Time] current time:2025-01-31 21:47:41
+[WeatherInformation] 用户家所在区域的气象信息是<省略的具体气象信息>
 DeviceControler：
 {
     "Action_type": "SeekHelp",
@@ -91,7 +85,7 @@ DeviceControler：
 }
 
 # Important Notes
-1. 每次回复仅执行一个动作。如果需要多个输入，应逐步请求。
+1. 每次回复仅执行一个动作。需要多个工具的返回信息时，在一次CallTools中同时调用所有互不依赖的工具；只有当一个工具的参数依赖另一个工具的返回结果时，才分多次调用。
 2. 仅修改具有write权限的属性。如果属性为只读，需通知用户。
 3. 仔细分析用户请求的每个前提，确保所有前提都得到充分支持后再发布指令。不得假设任何信息。
 4. 如果需要检查当前时间，必须调用 Time 工具。
@@ -100,18 +94,54 @@ DeviceControler：
 7. 你必须仅输出一个JSON字符串，不包含其他任何内容。
 """
 
+# 工具列表不随请求变化，放在系统提示词末尾，使提示词前缀在每次请求中保持一致，便于服务商缓存
+TOOL_LIST_MESSAGE = """
+# Tool list
+{tool_list}
+"""
+
+# 按变化频率从低到高排列：设备列表在相同的请求之间不变，传感器数据、时间和用户请求放在最后
 USER_MESSAGE = """
-User request: {user_request}
 Device list: {device_list}
-Tool list: {tool_list}
 Sensor data: {sensor_data}
 Dependency task information: {dependency_task_info}
+Prefetched information: {prefetched_info}
+User request: {user_request}
+"""
+
+# 较早的用户消息不再重复发送设备列表和传感器数据，最新的用户消息中总是包含完整的内容
+USER_SUMMARY_MESSAGE = """
+Device list: （见最新的用户消息）
+Sensor data: （见最新的用户消息）
+Dependency task information: {dependency_task_info}
+Prefetched information: （见最新的用户消息）
+User request: {user_request}
 """
 
 TOOL_MESSAGE = """
 Tool return information: {tool_return}
 """
 
+COMMAND_ERROR_MESSAGE = """
+以下指令未通过校验，没有被执行：
+{errors}
+请根据设备列表修正这些指令，重新输出完整的回复。
+"""
+
+# 每种Action_type的回复必须包含的字段
+ACTION_SCHEMAS = {
+    "Finish": ("Say_to_user",),
+    "AskUser": ("Say_to_user",),
+    "CallTools": (),  # Tools（或单个工具的Target_tool）由parse_tool_calls检查
+    "SeekHelp": ("Say_to_agent",),
+}
+
+# 修正后仍未通过校验的指令被丢弃时，告知用户哪些指令没有执行
+DROPPED_COMMANDS_MESSAGE = "抱歉，以下指令未通过校验，没有被执行：\n{errors}"
+PARTIAL_COMMANDS_MESSAGE = "{say_to_user}\n注意：以下指令未通过校验，没有被执行：\n{errors}"
+
+MAX_COMMAND_CORRECTIONS = 2  # 同一轮中请LLM修正指令的最大次数
+
 
 class ControlDevice(Action):
     def __init__(self, name="DeviceControler", context=None):
@@ -122,22 +152,23 @@ class ControlDevice(Action):
         self.time = time_tool_agent()
         self.tool_list = self.tool_agent_to_tool_list()
         self.tool_dict = self.tool_agent_to_tool_dict()
+        self.request = ""  # 本次任务中用户的全部输入，用于筛选相关设备
 
     def parse_output(self, output: str) -> dict:
-        """将LLM的输出转换为JSON字符串."""
-        match = re.search(r"```json\s*(.*?)\s*```", output, re.DOTALL)
-        if match:
-            return json.loads(match.group(1).strip())
-        return json.loads(output.strip())
+        """将LLM的输出转换为JSON，并检查Action_type和必需的字段."""
+        rsp_json = parse_action(output, ACTION_SCHEMAS)
+        if rsp_json["Action_type"] == "CallTools":
+            self.parse_tool_calls(rsp_json)
+        return rsp_json
 
     async def run(self, history_msg: list[Message], input: Message) -> Message:
         _logger.info(f"DeviceControler run: {input}")  # noqa: G004
 
         if not self.llm.sysmsg_added:
-            self.llm.add_system_msg(SYSTEM_MESSAGE)  # 将LLM的sysmsg_added设为True
+            self.llm.add_system_msg(
+                SYSTEM_MESSAGE + TOOL_LIST_MESSAGE.format(tool_list=self.tool_list)
+            )  # 将LLM的sysmsg_added设为True
 
-        all_context = CONFIG.hass_data["all_context"]
-        sensor_data = CONFIG.hass_data["all_sensor_data"]
         curr_time = await self.time.run(None)
 
         if input.attachment is not None:
@@ -148,38 +179,47 @@ class ControlDevice(Action):
 
         if input.role == "Tool":
             self.llm.add_user_msg(
-                TOOL_MESSAGE.format(tool_return=input.content)
+                TOOL_MESSAGE.format(tool_return=input.content),
+                summary=TOOL_MESSAGE.format(
+                    tool_return=summarize_observation(input.content)
+                ),
+                kind="tool",
             )  # 如果是工具的返回，会忽略input.attachment
         else:
+            self.request = f"{self.request}\n{input.content}".strip()
+            device_list = get_related_context(self.request)
+            # 已经预取到的天气等信息，无需再调用工具
+            prefetched = prefetched_context() or "None"
             self.llm.add_user_msg(
                 USER_MESSAGE.format(
                     user_request=input.content,
-                    device_list=all_context,
-                    tool_list=self.tool_list,
-                    sensor_data=sensor_data,
+                    device_list=encode_catalog(device_list),
+                    sensor_data=get_related_sensor_data(device_list),
                     dependency_task_info=dependency,
-                )
+                    prefetched_info=prefetched,
+                ),
+                summary=USER_SUMMARY_MESSAGE.format(
+                    user_request=input.content,
+                    dependency_task_info=dependency,
+                ),
+                kind="context",
             )
 
-        loop = asyncio.get_running_loop()
-        rsp = await loop.run_in_executor(
-            None, self.llm.chat_completion_text_v1, self.llm.history
-        )
+        rsp = await self._ask_llm()
         _logger.info(f"ControlDevice response: {rsp}")
         print(rsp)
-        rsp_json = self.parse_output(rsp)
+        rsp, rsp_json = await self._parse_with_reask(rsp, self.parse_output)
         self.llm.add_assistant_msg(rsp)
         _logger.info(f"DeviceControler rsp: {rsp}")
+        rsp_json = await self._correct_commands(rsp_json)
 
         if rsp_json["Action_type"] == "Finish":
             # 结束任务，执行命令，返回信息发给用户（发布到环境中）
             self.llm.reset()
+            self.request = ""
             say_to_user = rsp_json["Say_to_user"]
             if "Commands" in rsp_json:
-                commands = rsp_json["Commands"]
-                TRANSLATOR = Translator()
-                for command in commands:
-                    await TRANSLATOR.run_single_command(command)
+                await Translator().run_commands(rsp_json["Commands"])
             return Message(
                 role=self.name,
                 content=say_to_user,
@@ -201,25 +241,16 @@ class ControlDevice(Action):
 
         if rsp_json["Action_type"] == "CallTools":
             # 调用工具，工具返回的信息作为观察（observation）发回给自己
-            target_tool = rsp_json["Target_tool"]
-            arguments = rsp_json["Arguments"]
-            for tool in self.tool_list:
-                if tool["name"] == target_tool:
-                    tool_rsp = await self.tool_dict[target_tool].run(arguments)
-                    return Message(
-                        role="Tool",
-                        content="Observation:" + tool_rsp,
-                        sent_from=target_tool,
-                        send_to=["DeviceControler"],
-                        cause_by="UserResponse",
-                    )
-            # 若没有找到对应的工具：返回工具不可用的信息
+            # 多个工具并发调用，所有返回信息合并为一条观察
+            observation, sent_from = await self.call_tools(
+                self.parse_tool_calls(rsp_json)
+            )
             return Message(
                 role="Tool",
-                content=f"Observation: no available tool named {target_tool}",
-                sent_from="SYSTEM",
+                content=observation,
+                sent_from=sent_from,
                 send_to=["DeviceControler"],
-                cause_by="SYSTEM",
+                cause_by="UserResponse",
             )
 
         if rsp_json["Action_type"] == "SeekHelp":
@@ -249,7 +280,54 @@ class ControlDevice(Action):
             cause_by="SYSTEM",
         )
 
+    async def _correct_commands(self, rsp_json: dict) -> dict:
+        """执行前校验Finish中的指令，未通过时将错误信息发给LLM，在本轮内修正.
+
+        超过修正次数后仍未通过校验的指令会被丢弃，不再执行，回复中会列出这些指令。
+        """
+        translator = Translator()
+        for _ in range(MAX_COMMAND_CORRECTIONS):
+            if rsp_json.get("Action_type") != "Finish":
+                return rsp_json
+            errors = translator.validate_commands(rsp_json.get("Commands", []))
+            if not errors:
+                return rsp_json
+            _logger.warning(f"Invalid commands: {errors}")
+            self.llm.add_user_msg(COMMAND_ERROR_MESSAGE.format(errors="\n".join(errors)))
+            # 原回复可能已经推送给用户，修正后的回复不再推送
+            rsp = await self._ask_llm(streaming=False)
+            rsp, rsp_json = await self._parse_with_reask(rsp, self.parse_output)
+            self.llm.add_assistant_msg(rsp)
+            _logger.info(f"DeviceControler corrected rsp: {rsp}")
+
+        if rsp_json.get("Action_type") != "Finish" or "Commands" not in rsp_json:
+            return rsp_json
+        commands, errors = [], []
+        for command in rsp_json["Commands"]:
+            error = translator.validate_command(command)
+            if error is None:
+                commands.append(command)
+            else:
+                errors.append(error)
+        if errors:
+            # LLM的回复假定所有指令都已执行，需要说明哪些指令被丢弃
+            _logger.warning(f"Drop invalid commands: {errors}")
+            message = PARTIAL_COMMANDS_MESSAGE if commands else DROPPED_COMMANDS_MESSAGE
+            say_to_user = rsp_json["Say_to_user"]
+            rsp_json["Say_to_user"] = message.format(
+                say_to_user=say_to_user, errors="\n".join(errors)
+            )
+            stream = RESPONSE_STREAM.get()
+            if stream is not None and stream.emitted:
+                # 原回复已经推送给用户，补充推送被丢弃的指令
+                stream.emit(
+                    "\n" + PARTIAL_COMMANDS_MESSAGE.format(say_to_user="", errors="\n".join(errors)).strip()
+                )
+        rsp_json["Commands"] = commands
+        return rsp_json
+
     def reset(self):
         """清空LLM的history并将sysmsg_added设为False."""
         self.llm.reset()
+        self.request = ""
         _logger.info(f"{self.name} reset.")
@@ -1,12 +1,12 @@
-import asyncio
-import json
-
 from ..actions.action import Action
-from ..configs import CONFIG
+from ..catalog import encode_catalog
+from ..context_assistant import get_related_context
 from ..llm import LLM
 from ..message import Message
+from ..stream import RESPONSE_STREAM
 from ..translator import Translator
 from ..utils.logs import _logger
+from ..utils.parser import ParseError, parse_action
 from ..tool_agent import time_tool_agent
 
 SYSTEM_MESSAGE = """
@@ -15,7 +15,7 @@ SYSTEM_MESSAGE = """
 
 # 输入
 1. 用户请求
-2. 设备列表：与用户请求相关的设备信息，包括id、区域、类型和服务。每个设备的服务可能包含多个属性。
+2. 设备列表：与用户请求相关的设备信息，包括id、区域、类型和服务。每个设备的服务可能包含多个属性。设备列表采用紧凑格式：每个设备一行（id|name|area|type），其下缩进的每一行是一个属性（service.property|format|access|range|unit|description），access中r、w、n分别表示可读、可写、可通知，range为取值范围min..max/step或取值列表value=description。
 3. 依赖任务完成状态：如果用户的请求与其他设备控制任务的完成状态信息相关，则会提供此补充信息（例如：依赖任务是否完成或完成时间 ）。
 
 # 解决方案
@@ -38,8 +38,15 @@ SYSTEM_MESSAGE = """
 Example1:
 User:
 user request: 如果实验室的门打开了，就打开灯。
-device list: [{"id":1,"area":"laboratory","type":"light","services":{"light":{"on":{"description":"开关状态","format":"bool","access":["read","write","notify"]},"brightness":{"description":"亮度","format":"uint16","access":["read","write","notify"],"unit":"percentage","value-range":[1,65535,1]},"color_temperature":{"description":"色温","format":"uint32","access":["read","write","notify"],"unit":"kelvin","value-range":[2700,6500,1]}}}},
-{"id":2,"area":"laboratory","type":"magnet_sensor","services":{"magnet_sensor":{"contact_state":{"description":"接触状态","format":"bool","access":["read","notify"]}}}}]
+device list:
+# device: id|name|area|type
+#   property: service.property|format|access(r=read,w=write,n=notify)|range|unit|description
+1|实验室灯|laboratory|light
+  light.on|bool|rwn|||开关状态
+  light.brightness|uint16|rwn|1..65535|percentage|亮度
+  light.color_temperature|uint32|rwn|2700..6500|kelvin|色温
+2|实验室门窗传感器|laboratory|magnet_sensor
+  magnet_sensor.contact_state|bool|rn|||接触状态
 Assistant:
 {
     "Thought": "根据用户请求，使用实验室的磁性传感器作为trigger。设备ID为2，服务为magnet_sensor，属性为contact_state，值为true。实验室中的灯作为action，设备ID为1，服务为light，属性为on，值为true。",
@@ -51,7 +58,11 @@ Assistant:
 Example2:
 User:
 user request: 在空调关闭30分钟后打开加热器。
-device list: [{"id":3,"area":"bedroom","type":"heater","services":{"heater":{"power":{"description":"电源","format":"bool","access":["read","write","notify"]}}}}]
+device list:
+# device: id|name|area|type
+#   property: service.property|format|access(r=read,w=write,n=notify)|range|unit|description
+3|卧室加热器|bedroom|heater
+  heater.power|bool|rwn|||电源
 dependency task completion status: {"current time": "2025-02-08 15:00", "dependency":[{"content": "关闭空调", "finish time": "2025-02-08 14:59"}]}
 Assistant:
 {
@@ -62,16 +73,42 @@ Assistant:
 }
 """
 
+# 按变化频率从低到高排列：设备列表在相同的请求之间不变，时间和用户请求放在最后
 USER_MESSAGE = """
-user_request: {user_request}
 device_list: {device_list}
 dependency task completion status: {dependency_task_completion_status}
+user_request: {user_request}
+"""
+
+# 较早的用户消息不再重复发送设备列表，最新的用户消息中总是包含完整的内容
+USER_SUMMARY_MESSAGE = """
+device_list: （见最新的用户消息）
+dependency task completion status: {dependency_task_completion_status}
+user_request: {user_request}
 """
 
 FORMAT_EXAMPLE = """"""
 
 OUTPUT_MAPPING = {}
 
+TAP_ERROR_MESSAGE = """
+以下TAP无法转换为有效的自动化，没有被部署：
+{errors}
+请根据设备列表和TAP的格式要求修正这些TAP，重新输出完整的回复。
+"""
+
+# 修正后仍无效的TAP不会被部署，告知用户哪些自动化没有部署
+DROPPED_TAPS_MESSAGE = "抱歉，以下自动化未通过校验，没有被部署：\n{errors}"
+PARTIAL_TAPS_MESSAGE = "{say_to_user}\n注意：以下自动化未通过校验，没有被部署：\n{errors}"
+
+MAX_TAP_CORRECTIONS = 2  # 同一轮中请LLM修正TAP的最大次数
+
+# 每种Action_type的回复必须包含的字段
+ACTION_SCHEMAS = {
+    "Finish": ("TAP", "Say_to_user"),
+    "AskUser": ("Say_to_user",),
+}
+
 
 class GenerateTAP(Action):
     def __init__(self, name="TAPGenerator", context=None):
@@ -81,17 +118,16 @@ class GenerateTAP(Action):
         self.time = time_tool_agent()
 
     def parse_output(self, output: str) -> dict:
-        # TODO error handling
-        if output.startswith("```json"):
-            output = output[7:]
-            output = output[:-3]
-            return json.loads(output.strip())
-        elif output.startswith("```"):
-            output = output[3:]
-            output = output[:-3]
-            return json.loads(output.strip())
-        else:
-            return json.loads(output.strip())
+        """将LLM的输出转换为JSON，并检查Action_type和必需的字段."""
+        rsp_json = parse_action(output, ACTION_SCHEMAS)
+        if rsp_json["Action_type"] == "Finish":
+            if isinstance(rsp_json["TAP"], dict):
+                rsp_json["TAP"] = [rsp_json["TAP"]]
+            if not isinstance(rsp_json["TAP"], list) or not all(
+                isinstance(tap, dict) for tap in rsp_json["TAP"]
+            ):
+                raise ParseError("TAP应为由TAP对象组成的数组")
+        return rsp_json
 
     async def run(self, history_msg: list[Message], user_input: Message) -> Message:
         _logger.info(f"TapGenerator run: {user_input}")
@@ -104,7 +140,11 @@ class GenerateTAP(Action):
         if not self.llm.sysmsg_added:
             self.llm.add_system_msg(SYSTEM_MESSAGE)
 
-        all_context = CONFIG.hass_data["all_context"]
+        # 按首次请求及之后的用户回复筛选相关设备
+        request = self.user_request
+        if user_request != self.user_request:
+            request = f"{self.user_request}\n{user_request}"
+        device_list = get_related_context(request)
         curr_time = await self.time.run(None)
 
         # 暂时只在DeviceControler转发的请求中才会有依赖信息
@@ -116,19 +156,27 @@ class GenerateTAP(Action):
         self.llm.add_user_msg(
             USER_MESSAGE.format(
                 user_request=user_request,
-                device_list=all_context,
+                device_list=encode_catalog(device_list),
                 dependency_task_completion_status=dep,
-            )
+            ),
+            summary=USER_SUMMARY_MESSAGE.format(
+                user_request=user_request, dependency_task_completion_status=dep
+            ),
+            kind="context",
         )
 
-        loop = asyncio.get_running_loop()
-        rsp = await loop.run_in_executor(
-            None, self.llm.chat_completion_json_v1, self.llm.history
-        )
+        rsp = await self._ask_llm(json_mode=True)
         print(f"TAPGenerator: {rsp}")
         _logger.info(f"TapGenerator rsp: {rsp}")
-        # TODO error handling
-        rsp_json = self.parse_output(rsp)
+        rsp, rsp_json = await self._parse_with_reask(rsp, self.parse_output)
+
+        # 判断即将生成的TAP是否只运行一次
+        runOnce: bool = False
+        if (
+            user_input.attachment is not None and user_input.cause_by == "UserInput"
+        ):  # 因询问后用户回复的信息不含附加信息，会导致误判runOnce
+            runOnce = True  # 若附加信息不为空，说明请求来自DeviceControler，该任务只运行一次
+        rsp_json = await self._correct_taps(rsp, rsp_json, runOnce)
 
         if rsp_json["Action_type"] == "Finish":
             self.llm.reset()
@@ -136,16 +184,20 @@ class GenerateTAP(Action):
             say_to_user = rsp_json["Say_to_user"]
             TRANSLATOR = Translator()
 
-            # 判断即将生成的TAP是否只运行一次
-            runOnce: bool = False
-            if (
-                user_input.attachment is not None and user_input.cause_by == "UserInput"
-            ):  # 因询问后用户回复的信息不含附加信息，会导致误判runOnce
-                runOnce = True  # 若附加信息不为空，说明请求来自DeviceControler，该任务只运行一次
-
+            # 所有tap在一个事务中部署，只写入、检查和重载一次
+            transaction = TRANSLATOR.begin_automations()
+            failed = []
             for tap in tap_list:
                 # 多个tap同时部署只会出现在用户请求来自DeviceControler的情况下，此时所有的tap都只运行一次
-                await TRANSLATOR.deploy_tap(runOnce, self.user_request, tap)
+                error = await TRANSLATOR.deploy_tap(
+                    runOnce, self.user_request, tap, transaction
+                )
+                if error is not None:
+                    failed.append((tap, error))
+            await transaction.commit()
+            failed.extend(transaction.failed)
+            if failed:
+                say_to_user = self._report_failed(say_to_user, failed, len(tap_list))
 
             self.user_request = None
             return Message(
@@ -176,6 +228,39 @@ class GenerateTAP(Action):
             sent_from=None,
         )
 
+    async def _correct_taps(self, rsp: str, rsp_json: dict, runOnce: bool) -> dict:
+        """部署前检查Finish中的TAP，无效时将错误信息发给LLM，在本轮内修正."""
+        translator = Translator()
+        for _ in range(MAX_TAP_CORRECTIONS):
+            if rsp_json.get("Action_type") != "Finish":
+                return rsp_json
+            errors = []
+            for tap in rsp_json["TAP"]:
+                error = await translator.check_tap(runOnce, self.user_request, tap)
+                if error is not None:
+                    errors.append(f"{tap}：{error}")
+            if not errors:
+                return rsp_json
+            _logger.warning(f"Invalid TAPs: {errors}")
+            self.llm.add_assistant_msg(rsp)
+            self.llm.add_user_msg(TAP_ERROR_MESSAGE.format(errors="\n".join(errors)))
+            # 原回复可能已经推送给用户，修正后的回复不再推送
+            rsp = await self._ask_llm(json_mode=True, streaming=False)
+            rsp, rsp_json = await self._parse_with_reask(rsp, self.parse_output)
+            _logger.info(f"TapGenerator corrected rsp: {rsp}")
+        return rsp_json
+
+    def _report_failed(self, say_to_user: str, failed: list[tuple], total: int) -> str:
+        """在回复中列出没有部署的自动化."""
+        _logger.warning(f"TAPs not deployed: {failed}")
+        errors = "\n".join(f"{tap}：{error}" for tap, error in failed)
+        message = DROPPED_TAPS_MESSAGE if len(failed) >= total else PARTIAL_TAPS_MESSAGE
+        stream = RESPONSE_STREAM.get()
+        if stream is not None and stream.emitted:
+            # 原回复已经推送给用户，补充推送没有部署的自动化
+            stream.emit("\n" + PARTIAL_TAPS_MESSAGE.format(say_to_user="", errors=errors).strip())
+        return message.format(say_to_user=say_to_user, errors=errors)
+
     def reset(self):
         self.user_request = None
         self.llm.reset()
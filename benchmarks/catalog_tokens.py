@@ -0,0 +1,93 @@
+"""对比示例住宅的设备目录在str(dict)和紧凑编码（encode_catalog）下的token数.
+
+在custom_components目录下运行：python -m DomusGPT.benchmarks.catalog_tokens
+安装了tiktoken时使用cl100k_base计数，否则使用estimate_tokens估算。
+"""
+
+from ..catalog import encode_catalog, estimate_tokens
+
+
+def sample_house() -> list[dict]:
+    """生成用于对比编码效果的示例住宅设备目录."""
+    light = {
+        "light": {
+            "on": {"description": "Switch Status", "format": "bool", "access": ["read", "write", "notify"]},
+            "brightness": {"description": "Brightness", "format": "uint8", "access": ["read", "write", "notify"], "unit": "percentage", "value-range": [1, 100, 1]},
+            "color_temperature": {"description": "Color Temperature", "format": "uint32", "access": ["read", "write", "notify"], "unit": "kelvin", "value-range": [2700, 6500, 1]},
+        }
+    }
+    air_conditioner = {
+        "air_conditioner": {
+            "on": {"description": "Switch Status", "format": "bool", "access": ["read", "write", "notify"]},
+            "mode": {"description": "Mode", "format": "uint8", "access": ["read", "write", "notify"], "value-list": [{"value": 0, "description": "Auto"}, {"value": 1, "description": "Cool"}, {"value": 2, "description": "Dry"}, {"value": 3, "description": "Heat"}, {"value": 4, "description": "Fan"}]},
+            "target_temperature": {"description": "Target Temperature", "format": "float", "access": ["read", "write", "notify"], "unit": "celsius", "value-range": [16, 31, 0.5]},
+        },
+        "fan_control": {
+            "fan_level": {"description": "Fan Level", "format": "uint8", "access": ["read", "write", "notify"], "value-list": [{"value": 0, "description": "Auto"}, {"value": 1, "description": "Low"}, {"value": 2, "description": "Medium"}, {"value": 3, "description": "High"}]},
+        },
+    }
+    sensor = {
+        "temperature_humidity_sensor": {
+            "temperature": {"description": "Temperature", "format": "float", "access": ["read", "notify"], "unit": "celsius", "value-range": [-30, 100, 0.1]},
+            "relative_humidity": {"description": "Relative Humidity", "format": "uint8", "access": ["read", "notify"], "unit": "percentage", "value-range": [0, 100, 1]},
+        }
+    }
+    curtain = {
+        "curtain": {
+            "motor_control": {"description": "Motor Control", "format": "uint8", "access": ["write"], "value-list": [{"value": 0, "description": "Pause"}, {"value": 1, "description": "Open"}, {"value": 2, "description": "Close"}]},
+            "current_position": {"description": "Current Position", "format": "uint8", "access": ["read", "notify"], "unit": "percentage", "value-range": [0, 100, 1]},
+        }
+    }
+    templates = [
+        ("light", light, "灯"),
+        ("air_conditioner", air_conditioner, "空调"),
+        ("temperature_humidity_sensor", sensor, "温湿度计"),
+        ("curtain", curtain, "窗帘"),
+    ]
+    areas = [
+        ("living_room", "客厅"),
+        ("bedroom", "卧室"),
+        ("master_bedroom", "主卧"),
+        ("study", "书房"),
+        ("kitchen", "厨房"),
+        ("dining_room", "餐厅"),
+    ]
+    devices = []
+    for area, area_name in areas:
+        for device_type, services, name in templates:
+            devices.append(
+                {
+                    "id": len(devices) + 1,
+                    "name": f"{area_name}{name}",
+                    "area": area,
+                    "type": device_type,
+                    "services": services,
+                }
+            )
+    return devices
+
+
+def main():
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+
+        def count_tokens(text):
+            return len(encoding.encode(text))
+
+        counter = "tiktoken cl100k_base"
+    except ImportError:
+        count_tokens = estimate_tokens
+        counter = "estimate_tokens"
+
+    house = sample_house()
+    before = count_tokens(str(house))
+    after = count_tokens(encode_catalog(house))
+    print(f"devices: {len(house)}, counter: {counter}")
+    print(f"str(all_context): {before} tokens")
+    print(f"encode_catalog:   {after} tokens ({after / before:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""设备目录的紧凑编码：用按行、按列的文本代替str(dict)，大幅减少提示词中设备列表的token数.
+
+编码格式（每个设备一行，其下每个属性一行）：
+    id|name|area|type
+      service.property|format|access|range|unit|description
+access中r、w、n分别表示read、write、notify；range为min..max/step或value=description列表。
+"""
+
+from .configs import CONFIG
+
+CATALOG_HEADER = (
+    "# device: id|name|area|type\n"
+    "#   property: service.property|format|access(r=read,w=write,n=notify)|range|unit|description"
+)
+
+_ACCESS_CODES = {"read": "r", "write": "w", "notify": "n"}
+
+# catalog_version -> {设备id: 编码后的文本}，目录更新后旧版本的缓存自动失效
+_encoded_devices: dict[int, dict[int, str]] = {}
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数：中日韩字符按一个token计，其余字符按四个字符一个token计."""
+    cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def _format_number(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _encode_range(property: dict) -> str:
+    value_range = property.get("value-range")
+    if value_range:
+        text = f"{_format_number(value_range[0])}..{_format_number(value_range[1])}"
+        if len(value_range) > 2 and value_range[2] != 1:
+            text += f"/{_format_number(value_range[2])}"
+        return text
+    value_list = property.get("value-list")
+    if value_list:
+        return ",".join(
+            f"{item.get('value')}={item.get('description', '')}" for item in value_list
+        )
+    return ""
+
+
+def _clean(value) -> str:
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+def encode_device(device: dict) -> str:
+    """将all_context中的一个设备编码为紧凑文本."""
+    lines = [
+        "|".join(
+            _clean(device.get(key, ""))
+            for key in ("id", "name", "area", "type")
+        )
+    ]
+    for service_name, service in device.get("services", {}).items():
+        for property_name, property in service.items():
+            access = "".join(
+                _ACCESS_CODES.get(item, item[:1]) for item in property.get("access", [])
+            )
+            fields = [
+                f"{service_name}.{property_name}",
+                property.get("format", ""),
+                access,
+                _encode_range(property),
+                property.get("unit", ""),
+                property.get("description", ""),
+            ]
+            lines.append("  " + "|".join(_clean(field) for field in fields).rstrip("|"))
+    return "\n".join(lines)
+
+
+def get_encoded_device(device: dict) -> str:
+    """返回设备的紧凑编码，同一版本的目录中每个设备只编码一次."""
+    version = CONFIG.hass_data.get("catalog_version", 0)
+    cache = _encoded_devices.get(version)
+    if cache is None:
+        _encoded_devices.clear()
+        cache = _encoded_devices[version] = {}
+    encoded = cache.get(device["id"])
+    if encoded is None:
+        encoded = cache[device["id"]] = encode_device(device)
+    return encoded
+
+
+class DeviceList(list):
+    """设备列表，omitted为因token预算未列出的设备数量."""
+
+    omitted: int = 0
+
+
+def encode_catalog(devices: list[dict]) -> str:
+    """将设备列表编码为提示词中使用的紧凑文本，列表被截断时在末尾注明未列出的设备数量."""
+    lines = [CATALOG_HEADER, *(get_encoded_device(device) for device in devices)]
+    omitted = getattr(devices, "omitted", 0)
+    if omitted:
+        lines.append(f"# ...and {omitted} more devices not listed (truncated to fit the prompt)")
+    return "\n".join(lines)
@@ -28,6 +28,37 @@ DEFAULT_BASE_URL = "https://api.openai-proxy.org/v1"
 DEFAULT_TEMPERATURE = 0.7
 DEFAULT_MAX_TOKENS = 1024
 DEFAULT_ACCESS_TOKEN = ""
+# 共享的LLM HTTP连接池参数
+CONF_MAX_CONNECTIONS = "max_connections"
+CONF_MAX_KEEPALIVE_CONNECTIONS = "max_keepalive_connections"
+CONF_REQUEST_TIMEOUT = "request_timeout"
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 10
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_REQUEST_TIMEOUT = 60.0
+# Supervisor会话管理：每个conversation_id对应一个独立的会话
+DEFAULT_MAX_SESSIONS = 16  # 最多保留的会话数，超出时淘汰最久未使用的空闲会话
+DEFAULT_SESSION_IDLE_TIMEOUT = 600  # 会话空闲超过该秒数后被淘汰
+DEFAULT_MAX_CONCURRENT_SESSIONS = 6  # 同时处理请求的会话数上限
+# Environment每轮对话的时间预算：整轮的总时长，以及单个角色一次运行（含LLM请求和工具调用）的时长
+DEFAULT_TURN_TIMEOUT = 300  # 秒
+DEFAULT_ROLE_TIMEOUT = 120  # 秒
+DEFAULT_ENV_HISTORY_SIZE = 200  # Environment.history最多保留的消息数
+# 每次请求中设备列表占用的token预算（get_related_context）
+DEFAULT_CONTEXT_TOKEN_BUDGET = 2000
+# 每次请求LLM时对话历史的token预算，以及较早的工具返回信息保留的字符数
+DEFAULT_HISTORY_TOKEN_BUDGET = 8000
+DEFAULT_OBSERVATION_SUMMARY_CHARS = 200
+# Router任务分解结果缓存
+DEFAULT_ROUTER_CACHE_SIZE = 256
+DEFAULT_ROUTER_CACHE_TTL = 7 * 24 * 3600  # 秒
+DEFAULT_ROUTER_CACHE_FUZZY_THRESHOLD = 0.9  # 模糊匹配的相似度阈值，设为1.0时只做精确匹配
+# MIoT设备规格的下载与缓存
+DEFAULT_SPEC_FETCH_CONCURRENCY = 8  # 同时下载的规格数
+DEFAULT_SPEC_FETCH_TIMEOUT = 120  # 秒，型号列表较大，超时时间需留有余量
+DEFAULT_SPEC_CACHE_MAX_AGE = 7 * 24 * 3600  # 秒，超过后用ETag/Last-Modified向服务器确认是否有更新
+# 流式输出的增量回复通过该事件发布到HA事件总线
+EVENT_RESPONSE_DELTA = f"{DOMAIN}_response_delta"
 DATA_PATH = "DomusGPT_data"  # 这里做了修改
 # 原先内容是 DATA_PATH = "/config/.storage/chatiot_conversation"
 WORK_PATH = "/config/custom_components/DomusGPT"
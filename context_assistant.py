@@ -2,96 +2,22 @@
 # compress the data
 import asyncio
 import os
+import re
+from collections import defaultdict
+from copy import deepcopy
 
 import requests
+from homeassistant.const import EVENT_STATE_CHANGED
+from homeassistant.core import HomeAssistant, callback
 
+from .catalog import DeviceList, estimate_tokens, get_encoded_device
 from .configs import CONFIG
-from .const import DATA_PATH
+from .const import DATA_PATH, DEFAULT_CONTEXT_TOKEN_BUDGET
+from .miot_spec import info_path
 from .utils.logs import _logger
 from .utils.utils import get_json, write_json
 
 
-def download_instance():  # noqa: D103
-    if not os.path.exists(f"{DATA_PATH}/temp/miot"):
-        os.makedirs(f"{DATA_PATH}/temp/miot")
-    if os.path.exists(f"{DATA_PATH}/temp/miot/model_type.json"):
-        model_type = get_json(f"{DATA_PATH}/temp/miot/model_type.json")
-        CONFIG.hass_data["model_type"] = model_type
-    else:
-        url = "http://miot-spec.org/miot-spec-v2/instances?status=all"
-        res = requests.get(url)
-        instances = res.json()
-        model_type = {}
-        for instance in instances["instances"]:
-            model = instance["model"]
-            if model not in model_type:
-                model_type[model] = instance["type"]
-        write_json(f"{DATA_PATH}/temp/miot/instances.json", instances)
-        write_json(f"{DATA_PATH}/temp/miot/model_type.json", model_type)
-        CONFIG.hass_data["model_type"] = model_type
-
-
-def download_spec_by_model(model: str):
-    if model not in CONFIG.hass_data["model_type"]:
-        _logger.error(f"Model {model} not found.")
-        return None
-    if not os.path.exists(f"{DATA_PATH}/temp/miot/spec"):
-        os.makedirs(f"{DATA_PATH}/temp/miot/spec")
-    if os.path.exists(f"{DATA_PATH}/temp/miot/spec/{model}.json"):
-        return get_json(f"{DATA_PATH}/temp/miot/spec/{model}.json")
-    else:
-        miot_type = CONFIG.hass_data["model_type"][model]
-        url = f"http://miot-spec.org/miot-spec-v2/instance?type={miot_type}"
-        res = requests.get(url)
-        spec = res.json()
-        write_json(f"{DATA_PATH}/temp/miot/spec/{model}.json", spec)
-        return spec
-
-
-def download_spec_by_models(models: list[str]):
-    for model in models:
-        download_spec_by_model(model)
-
-
-def convert_spec_to_info(spec: dict) -> dict:
-    device_type = spec["type"].split(":")[3]
-    device_type = device_type.replace("-", "_")
-    info = {"type": device_type, "services": {}}
-    for service in spec["services"][1:]:
-        service_type = service["type"].split(":")[3]
-        service_type = service_type.replace("-", "_")
-        service_obj = {}
-        for property in service.get("properties", []):
-            property_type = property["type"].split(":")[3]
-            property_type = property_type.replace("-", "_")
-            property_value = {
-                k: v for k, v in property.items() if k not in ["iid", "type"]
-            }
-            if property_value.get("access", []) != []:
-                service_obj[property_type] = property_value
-        info["services"][service_type] = service_obj
-        if info["services"][service_type] == {}:
-            info["services"].pop(service_type)
-    return info
-
-
-def get_miot_info():
-    miot_devices = CONFIG.hass_data["miot_devices"]
-    if not os.path.exists(f"{DATA_PATH}/temp/miot/info"):
-        os.makedirs(f"{DATA_PATH}/temp/miot/info")
-    for device in miot_devices:
-        model = device["model"]
-        if os.path.exists(f"{DATA_PATH}/temp/miot/info/{model}.json"):
-            continue
-        if not os.path.exists(f"{DATA_PATH}/temp/miot/spec/{model}.json"):
-            spec = download_spec_by_model(model)
-        else:
-            spec = get_json(f"{DATA_PATH}/temp/miot/spec/{model}.json")
-        if spec:
-            info = convert_spec_to_info(spec)
-            write_json(f"{DATA_PATH}/temp/miot/info/{model}.json", info)
-
-
 def get_miot_devices():
     # 正式部署版本的device_file路径为"/config/.storage/core.device_registry"
     device_file = "config/.storage/core.device_registry"
@@ -128,6 +54,7 @@ def get_miot_devices():
 
 
 async def get_all_states():
+    """通过REST API获取全部实体状态并载入STATE_STORE（未在HA中订阅状态变化时使用）."""
     loop = asyncio.get_event_loop()
     access_token = CONFIG.hass_data["access_token"]
     _logger.debug(f"access_token: {access_token}")
@@ -142,88 +69,176 @@ async def get_all_states():
         return requests.get(url=url, headers=headers)
 
     response = await loop.run_in_executor(None, test)
-    if response.status_code == 200:
-        states = response.json()
-        _logger.debug(f"states: \n{states}")
-    else:
+    if response.status_code != 200:
         _logger.error(f"Fail to get states: {response.status_code}: {response.text}")
-    CONFIG.hass_data["states"] = states
-    write_json(f"{DATA_PATH}/temp/miot/states.json", states)
+        return
+    states = response.json()
+    _logger.debug(f"states number: {len(states)}")
+    STATE_STORE.load(states)
+
+
+# 部分传感器属性在实体中使用的字段名与MIoT spec中的不同
+FIELD_ALIASES = {
+    "illumination_sensor.illumination": "illumination-2-1",
+    "temperature_humidity_sensor.temperature": "temperature-2-1",
+    "temperature_humidity_sensor.relative_humidity": "relative_humidity-2-2",
+}
+
+
+class EntityIndex:
+    """实体状态的索引，索引中只保存entity_id，查询时从states中取最新的状态.
+
+    实体的属性值变化不需要更新索引，只有实体增删、属性字段或mac变化时才需要重建。
+    """
+
+    def __init__(self, states: dict[str, dict]):
+        self.states = states
+        self.by_field_mac: dict[tuple[str, str], str] = {}  # (属性字段, mac) -> entity_id
+        self.by_mac: dict[str, str] = {}  # mac -> 第一个自身带有mac属性的实体
+        self.by_mac_address: dict[str, list[str]] = defaultdict(list)
+        self.children: dict[str, list[str]] = defaultdict(list)  # parent_entity_id -> 子实体
+
+        for entity_id, entity in states.items():
+            attributes = entity.get("attributes", {})
+            parent_id = attributes.get("parent_entity_id")
+            if parent_id is not None:
+                self.children[parent_id].append(entity_id)
+
+            mac = self._inherited(attributes, "mac")
+            if mac:
+                for field in attributes:
+                    self.by_field_mac.setdefault((field, mac), entity_id)
+            if attributes.get("mac"):
+                self.by_mac.setdefault(str(attributes["mac"]).lower(), entity_id)
+
+            mac_address = self._inherited(attributes, "mac_address")
+            if mac_address:
+                self.by_mac_address[mac_address].append(entity_id)
+
+    def _inherited(self, attributes: dict, key: str) -> str:
+        """返回实体自身的key属性，子实体没有该属性时使用父实体的."""
+        if key in attributes:
+            return str(attributes.get(key) or "").lower()
+        parent_id = attributes.get("parent_entity_id")
+        if parent_id is None:
+            return ""
+        parent = self.states.get(parent_id, {})
+        return str(parent.get("attributes", {}).get(key) or "").lower()
+
+
+def _index_shape(entity: dict | None):
+    """实体中影响索引的部分，该部分不变时状态更新无需重建索引."""
+    if entity is None:
+        return None
+    attributes = entity.get("attributes", {})
+    return (
+        frozenset(attributes),
+        attributes.get("mac"),
+        attributes.get("mac_address"),
+        attributes.get("parent_entity_id"),
+    )
+
+
+class StateStore:
+    """内存中的实体状态存储，通过HA事件总线的state_changed事件增量更新."""
+
+    def __init__(self):
+        self.states: dict[str, dict] = {}
+        self.version = 0  # 每次状态变化加一
+        self._index: EntityIndex | None = None
+        self._unsub = None
+
+    @property
+    def index(self) -> EntityIndex:
+        if self._index is None:
+            self._index = EntityIndex(self.states)
+        return self._index
+
+    def load(self, states: list[dict]):
+        """用完整的状态列表替换当前存储."""
+        self.states = {entity["entity_id"]: entity for entity in states}
+        self._index = None
+        self.version += 1
+
+    def update(self, entity_id: str, new_state: dict | None):
+        """更新单个实体的状态，new_state为None表示实体被移除."""
+        old_state = self.states.get(entity_id)
+        if new_state is None:
+            self.states.pop(entity_id, None)
+        else:
+            self.states[entity_id] = new_state
+        if _index_shape(old_state) != _index_shape(new_state):
+            self._index = None  # 下次查询时重建
+        self.version += 1
+
+    @callback
+    def async_track(self, hass: HomeAssistant):
+        """从hass.states载入当前状态，并订阅之后的状态变化."""
+        self.async_stop()
+        self.load([state.as_dict() for state in hass.states.async_all()])
+
+        @callback
+        def _state_changed(event):
+            new_state = event.data.get("new_state")
+            self.update(
+                event.data["entity_id"],
+                new_state.as_dict() if new_state is not None else None,
+            )
+
+        self._unsub = hass.bus.async_listen(EVENT_STATE_CHANGED, _state_changed)
+        _logger.debug(f"Track {len(self.states)} states")
+
+    @callback
+    def async_stop(self):
+        if self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+
+
+STATE_STORE = StateStore()
 
 
 def find_entity_by_entity_id(entity_id):
-    entities = CONFIG.hass_data["states"]
-    for entity in entities:
-        if entity["entity_id"] == entity_id:
-            return entity
-    return None
+    return STATE_STORE.states.get(entity_id)
 
 
 def find_entity_by_field_mac(field, mac_address):
-    additional_fields_original = [
-        "illumination_sensor.illumination",
-        "temperature_humidity_sensor.temperature",
-        "temperature_humidity_sensor.relative_humidity",
-    ]
-    additional_fields_new = [
-        "illumination-2-1",
-        "temperature-2-1",
-        "relative_humidity-2-2",
-    ]
-    for i, additional_field in enumerate(additional_fields_original):
-        if field == additional_field:
-            field = additional_fields_new[i]
-            break
-    entities = CONFIG.hass_data["states"]  # states.json
-
-    for entity in entities:
-        attributes = entity.get("attributes", {})
-        if field in attributes:
-            # 李安：此处代码原先检查的key是mac_address，但实际上是mac，所以我修改了一下
-            if "mac" in attributes:
-                if attributes.get("mac", "").lower() == mac_address.lower():
-                    # print(f"Entity found: {field}, {mac_address}")
-                    return entity
-            elif "parent_entity_id" in attributes:
-                parent_entity_state = find_entity_by_entity_id(
-                    attributes["parent_entity_id"]
-                )
-                parent_attributes = parent_entity_state.get("attributes", {})
-                # 李安：此处代码原先检查的key是mac_address，但实际上是mac，所以我修改了一下
-                if "mac" in parent_attributes:
-                    if attributes.get("mac", "").lower() == mac_address.lower():
-                        # print(f"Entity found: {field}, {mac_address}")
-                        return entity
-    # print(f"Entity not found: {field} {mac_address}")
-    return None
+    field = FIELD_ALIASES.get(field, field)
+    entity_id = STATE_STORE.index.by_field_mac.get((field, mac_address.lower()))
+    return STATE_STORE.states.get(entity_id)
 
 
 def find_entities_by_device(device):
-    entities_by_device = []
-    mac_address = device["mac_address"]
-    for entity in CONFIG.hass_data["states"]:
-        attributes = entity.get("attributes", {})
-        if "mac_address" in attributes:
-            if attributes.get("mac_address", "").lower() == mac_address.lower():
-                entities_by_device.append(entity)
-        elif "parent_entity_id" in attributes:
-            parent_entity = find_entity_by_entity_id(attributes["parent_entity_id"])
-            parent_attributes = parent_entity.get("attributes", {})
-            if "mac_address" in parent_attributes:
-                if attributes.get("mac_address", "").lower() == mac_address.lower():
-                    entities_by_device.append(entity)
-    return entities_by_device
-
-
-def get_all_context():
+    entity_ids = STATE_STORE.index.by_mac_address.get(device["mac_address"].lower(), [])
+    return [STATE_STORE.states[entity_id] for entity_id in entity_ids]
+
+
+def load_device_info() -> dict[str, dict]:
+    """读取所有设备型号的info文件，返回型号 -> info；读取文件是阻塞操作，应在执行器中运行."""
+    infos = {}
+    for device in CONFIG.hass_data["miot_devices"]:
+        model = device["model"]
+        if model not in infos and os.path.exists(info_path(model)):
+            infos[model] = get_json(info_path(model))
+    return infos
+
+
+def get_all_context(infos: dict[str, dict]):
+    """根据设备的info和STATE_STORE中的实体生成设备列表.
+
+    STATE_STORE在事件循环中更新，因此本函数只能在事件循环中调用；info文件由load_device_info预先读取。
+    """
     miot_devices = CONFIG.hass_data["miot_devices"]  # 内容就是devices.json
     # print(miot_devices)
-    get_miot_info()
     all_context = []
     for device in miot_devices:
         single_device_context = {}
         model = device["model"]
-        info = get_json(f"{DATA_PATH}/temp/miot/info/{model}.json")
+        if model not in infos:
+            # 规格下载失败（get_miot_info）的设备暂不加入设备列表
+            _logger.warning(f"No MIoT spec for device {device['id']} ({model}), skipped.")
+            continue
+        info = deepcopy(infos[model])  # 同型号的设备共用info，下面会删除其中的属性
         _logger.debug(f"info: {info}")
         single_device_context["id"] = device["id"]
         single_device_context["name"] = device["name"]
@@ -249,40 +264,173 @@ def get_all_context():
         single_device_context["services"] = services
         all_context.append(single_device_context)
     CONFIG.hass_data["all_context"] = all_context
-    write_json(f"{DATA_PATH}/temp/miot/all_context.json", all_context)
+    # 设备目录更新后，已缓存的紧凑编码随版本号失效
+    CONFIG.hass_data["catalog_version"] = CONFIG.hass_data.get("catalog_version", 0) + 1
+
+
+def save_all_context():
+    """将设备列表写入文件，便于调试；应在执行器中运行."""
+    write_json(f"{DATA_PATH}/temp/miot/all_context.json", CONFIG.hass_data["all_context"])
+
+
+# 设备类型的中英文别名（包括与之相关的环境描述），用于从用户请求中识别相关设备
+DEVICE_TYPE_ALIASES = {
+    "light": ["灯", "照明", "亮度", "色温", "暗", "light", "lamp", "bright"],
+    "air_conditioner": ["空调", "冷", "热", "制热", "制冷", "温度", "air conditioner", "ac", "cool", "warm"],
+    "heater": ["取暖", "加热", "暖气", "冷", "heater"],
+    "humidifier": ["加湿", "干燥", "湿度", "humidifier", "dry"],
+    "dehumidifier": ["除湿", "潮湿", "湿度", "dehumidifier", "humid"],
+    "air_purifier": ["净化", "空气质量", "purifier", "air quality"],
+    "fan": ["风扇", "fan"],
+    "television": ["电视", "tv", "television"],
+    "speaker": ["音箱", "音响", "音量", "speaker", "volume"],
+    "curtain": ["窗帘", "curtain", "blind"],
+    "outlet": ["插座", "outlet", "plug", "socket"],
+    "switch": ["开关", "switch"],
+    "magnet_sensor": ["门", "窗", "door", "window"],
+    "motion_sensor": ["人体", "有人", "motion"],
+    "temperature_humidity_sensor": ["温湿度", "温度", "湿度", "冷", "热", "干燥", "潮湿", "temperature", "humidity"],
+    "illumination_sensor": ["光照", "照度", "暗", "亮", "illumination"],
+    "vacuum": ["扫地", "vacuum"],
+    "washer": ["洗衣", "washer"],
+    "water_heater": ["热水器", "water heater"],
+}
+
+AREA_ALIASES = {
+    "bedroom": ["卧室", "睡房"],
+    "master_bedroom": ["主卧"],
+    "living_room": ["客厅"],
+    "kitchen": ["厨房"],
+    "bathroom": ["浴室", "卫生间", "厕所"],
+    "study": ["书房"],
+    "dining_room": ["餐厅"],
+    "balcony": ["阳台"],
+    "laboratory": ["实验室"],
+    "office": ["办公室"],
+}
+
+# 请求涉及全部设备时不做筛选
+ALL_DEVICES_KEYWORDS = ["所有设备", "全部设备", "哪些设备", "什么设备", "所有的设备", "all devices", "which devices", "every device"]
+
+
+def match_keywords(request: str, keywords) -> bool:
+    """请求中是否包含任一关键词，英文关键词按整词匹配."""
+    for keyword in keywords:
+        if not keyword:
+            continue
+        if keyword.isascii():
+            if re.search(rf"\b{re.escape(keyword)}\b", request):
+                return True
+        elif keyword in request:
+            return True
+    return False
+
+
+def area_keywords(device: dict) -> list[str]:
+    """设备所在区域的各种说法."""
+    area = str(device.get("area", "")).lower()
+    if area == "unknown":
+        return []
+    return [area, area.replace("_", " "), *AREA_ALIASES.get(area, [])]
+
+
+def _score_device(request: str, device: dict) -> int:
+    """根据设备名称、区域、类型及服务/属性与请求的匹配程度打分，0表示不相关."""
+    score = 0
+    name = str(device.get("name", "")).lower()
+    if name and (name in request or match_keywords(request, _bigrams(name))):
+        score += 5
+    if match_keywords(request, area_keywords(device)):
+        score += 3
+    device_type = str(device.get("type", "")).lower()
+    if match_keywords(request, [device_type.replace("_", " "), *DEVICE_TYPE_ALIASES.get(device_type, [])]):
+        score += 4
+    for service_name, service in device.get("services", {}).items():
+        for property_name, property in service.items():
+            description = str(property.get("description", "")) if isinstance(property, dict) else ""
+            if match_keywords(
+                request,
+                [
+                    property_name.replace("_", " "),
+                    service_name.replace("_", " "),
+                    description if len(description) >= 2 else "",
+                ],
+            ):
+                score += 1
+    return score
+
+
+def _bigrams(text: str) -> list[str]:
+    """中文名称的二元组，用于匹配“卧室的灯”与“卧室灯”这类不完全一致的说法."""
+    if not any("一" <= ch <= "鿿" for ch in text):
+        return []
+    return [text[i : i + 2] for i in range(len(text) - 1) if "一" <= text[i] <= "鿿"]
+
+
+def get_related_context(request: str, token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET) -> DeviceList:
+    """从all_context中筛选与请求相关的设备，总长度不超过token_budget.
+
+    请求涉及全部设备时返回全部设备，不受预算限制；没有任何设备与请求相关时，按原顺序返回预算内的设备，
+    未列出的设备数量记录在返回值的omitted中。返回的设备保持all_context中的顺序，便于相同的请求得到相同的提示词。
+    """
+    all_context = CONFIG.hass_data["all_context"]
+    request = request.lower()
+    if match_keywords(request, ALL_DEVICES_KEYWORDS):
+        # “所有设备”必须全部列出，截断后会漏掉设备
+        return DeviceList(all_context)
+    scored = [(_score_device(request, device), device) for device in all_context]
+    best = max((score for score, _ in scored), default=0)
+    # 只保留得分不低于最高分一半的设备，避免仅因“on”这类通用属性名匹配而被选中
+    scored = [item for item in scored if item[0] > 0 and item[0] * 2 >= best]
+    scored.sort(key=lambda item: item[0], reverse=True)  # sort是稳定的，同分时保持原顺序
+    candidates = [device for _, device in scored] if scored else list(all_context)
+
+    selected = []
+    used = 0
+    for device in candidates:
+        cost = estimate_tokens(get_encoded_device(device))
+        if used + cost > token_budget and selected:
+            break
+        selected.append(device)
+        used += cost
+    selected_ids = {device["id"] for device in selected}
+    related = DeviceList(device for device in all_context if device["id"] in selected_ids)
+    related.omitted = len(candidates) - len(selected)
+    _logger.debug(
+        f"related devices: {[device['id'] for device in related]}, tokens: {used}, "
+        f"omitted: {related.omitted}"
+    )
+    return related
 
 
-# TODO
-def get_related_context(request: str):
-    pass
+def get_related_sensor_data(devices: list[dict]) -> list[dict]:
+    """返回指定设备的传感器数据."""
+    ids = {device["id"] for device in devices}
+    return [data for data in get_all_sensor_data() if data["id"] in ids]
 
 
 def get_sensor_data_by_mac(mac_address: str):
-    entities = CONFIG.hass_data["states"]
-    for entity in entities:
-        attributes = entity.get("attributes", {})
-        if (
-            "mac" in attributes
-            and attributes.get("mac", "").lower() == mac_address.lower()
-        ):
-            # 复制原始属性，避免修改原始数据
-            filtered_attributes = attributes.copy()
-            # 需要删除的字段
-            keys_to_remove = {
-                "converters",
-                "customizes",
-                "device_class",
-            }
-            # 执行删除
-            for key in keys_to_remove:
-                filtered_attributes.pop(key, None)
-
-            return filtered_attributes
-    return None
+    entity = STATE_STORE.states.get(STATE_STORE.index.by_mac.get(mac_address.lower()))
+    if entity is None:
+        return None
+    # 复制原始属性，避免修改原始数据
+    filtered_attributes = dict(entity.get("attributes", {}))
+    # 需要删除的字段
+    keys_to_remove = {
+        "converters",
+        "customizes",
+        "device_class",
+    }
+    # 执行删除
+    for key in keys_to_remove:
+        filtered_attributes.pop(key, None)
+    return filtered_attributes
 
 
 def get_all_sensor_data():
-    """获取所有已经接入的MIoT设备的传感器数据."""
+    """获取所有已经接入的MIoT设备的传感器数据，状态未变化时直接返回缓存."""
+    if CONFIG.hass_data.get("all_sensor_data_version") == STATE_STORE.version:
+        return CONFIG.hass_data["all_sensor_data"]
     miot_devices = CONFIG.hass_data["miot_devices"]
     all_sensor_data = []
     for device in miot_devices:
@@ -293,5 +441,5 @@ def get_all_sensor_data():
         if sensor_data:
             all_sensor_data.append(sensor_data)
     CONFIG.hass_data["all_sensor_data"] = all_sensor_data
-    write_json(f"{DATA_PATH}/temp/miot/all_sensor_data.json", all_sensor_data)
+    CONFIG.hass_data["all_sensor_data_version"] = STATE_STORE.version
     return all_sensor_data
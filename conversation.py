@@ -13,6 +13,7 @@ from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import MATCH_ALL
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers import intent
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.util import ulid
 from .const import (
@@ -22,19 +23,29 @@ from .const import (
     DEFAULT_PROVIDER,
     WORK_PATH,
     DATA_PATH,
+    EVENT_RESPONSE_DELTA,
+    CONF_MAX_CONNECTIONS,
+    CONF_MAX_KEEPALIVE_CONNECTIONS,
+    CONF_REQUEST_TIMEOUT,
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+    DEFAULT_REQUEST_TIMEOUT,
 )
 import sys
 
 sys.path.append(WORK_PATH)
 from .configs import CONFIG
 from .context_assistant import (
-    download_instance,
-    get_miot_info,
     get_miot_devices,
-    get_all_states,
     get_all_context,
     get_all_sensor_data,
+    load_device_info,
+    save_all_context,
+    STATE_STORE,
 )
+from .llm import get_async_client
+from .miot_spec import get_miot_info
+from .stream import RESPONSE_STREAM, ResponseStream
 from .utils.utils import delete_all_files_in_folder
 
 
@@ -96,6 +107,7 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
     async def async_will_remove_from_hass(self) -> None:
         """When entity will be removed from Home Assistant."""
         ha_conversation.async_unset_agent(self.hass, self.entry)
+        STATE_STORE.async_stop()
         await super().async_will_remove_from_hass()
 
     @property
@@ -128,7 +140,7 @@ class LocalLLMAgent(ConversationEntity, AbstractConversationAgent):
             _logger.debug(f"conversation_id: {conversation_id}")
             _logger.debug(f"conversation: {conversation}")
             response = await self._async_generate(
-                conversation
+                conversation, conversation_id
             )  # 这里调用了子类GenericOpenAIAPIAgent的_async_generate方法
             _logger.debug(f"response: {response}")
 
@@ -169,6 +181,15 @@ class GenericOpenAIAPIAgent(LocalLLMAgent):
         CONFIG.configs_llm["base_url"] = entry.data["base_url"]
         CONFIG.configs_llm["temperature"] = entry.data["temperature"]
         CONFIG.configs_llm["max_tokens"] = entry.data["max_tokens"]
+        CONFIG.configs_llm[CONF_MAX_CONNECTIONS] = entry.data.get(
+            CONF_MAX_CONNECTIONS, DEFAULT_MAX_CONNECTIONS
+        )
+        CONFIG.configs_llm[CONF_MAX_KEEPALIVE_CONNECTIONS] = entry.data.get(
+            CONF_MAX_KEEPALIVE_CONNECTIONS, DEFAULT_MAX_KEEPALIVE_CONNECTIONS
+        )
+        CONFIG.configs_llm[CONF_REQUEST_TIMEOUT] = entry.data.get(
+            CONF_REQUEST_TIMEOUT, DEFAULT_REQUEST_TIMEOUT
+        )
         CONFIG.hass_data["access_token"] = entry.data["access_token"]
         CONFIG.hass_data["Weather Service API Key"] = entry.data[
             "Weather Service API Key"
@@ -188,28 +209,49 @@ class GenericOpenAIAPIAgent(LocalLLMAgent):
                 f"{DATA_PATH}/temp",
             )
         await self.hass.async_add_executor_job(get_miot_devices)
-        await self.hass.async_add_executor_job(download_instance)
-        await self.hass.async_add_executor_job(get_miot_info)
-        await get_all_states()
-        await self.hass.async_add_executor_job(get_all_context)
-        await self.hass.async_add_executor_job(get_all_sensor_data)
+        # 规格缓存在DATA_PATH/cache中，不随temp清空，只下载缺失或已过期的规格
+        await get_miot_info(async_get_clientsession(self.hass))
+        STATE_STORE.async_track(self.hass)  # 订阅状态变化，此后无需再请求/api/states
+        # 设备列表和传感器数据只读取内存中的STATE_STORE，必须在事件循环中生成，
+        # 避免与_state_changed同时修改states；只有读写文件在执行器中进行
+        infos = await self.hass.async_add_executor_job(load_device_info)
+        get_all_context(infos)
+        get_all_sensor_data()
+        await self.hass.async_add_executor_job(save_all_context)
 
-        from .Supervisor import SUPERVISOR
+        # 在执行器中预先创建共享的异步LLM客户端（加载SSL证书是阻塞操作）
+        await self.hass.async_add_executor_job(get_async_client)
 
-        self.supervisor = SUPERVISOR
+        from .Supervisor import SUPERVISOR_MANAGER
+
+        self.supervisor = SUPERVISOR_MANAGER
 
         from .translator import Translator
 
         self.translator = Translator(self.hass)
+        self.translator.build_command_table()  # 设备目录已加载，预先生成指令执行表
+
+    async def _async_generate(
+        self, conversation: list[dict], conversation_id: str
+    ) -> str:
+        # 回复生成过程中，面向用户的内容会以EVENT_RESPONSE_DELTA事件增量推送，
+        # 语音卫星等订阅者无需等待整个Agent流程结束即可开始播报
+        def on_delta(delta: str):
+            self.hass.bus.async_fire(
+                EVENT_RESPONSE_DELTA,
+                {"conversation_id": conversation_id, "delta": delta},
+            )
 
-    async def _async_generate(self, conversation: list[dict]) -> str:
+        token = RESPONSE_STREAM.set(ResponseStream(on_delta))
         try:
             result = await self.supervisor.run(
-                conversation[-1]["message"]
-            )  # Agent处理对话的入口
+                conversation_id, conversation[-1]["message"]
+            )  # Agent处理对话的入口，每个conversation_id拥有独立的会话
             _logger.debug(f"result: {result}")
             return result
         except Exception as err:
             _logger.error(f"Error generating response: {err}")
             _logger.error(f"Traceback: {traceback.format_exc()}")
             return f"Error generating response: {err}"
+        finally:
+            RESPONSE_STREAM.reset(token)
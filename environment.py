@@ -1,8 +1,10 @@
 import asyncio
+from collections import deque
 
 from pydantic import BaseModel, Field
 
 from .configs import CONFIG
+from .const import DEFAULT_ENV_HISTORY_SIZE, DEFAULT_ROLE_TIMEOUT, DEFAULT_TURN_TIMEOUT
 from .memory import Memory
 from .message import Message
 from .roles.chatbot import Chatbot
@@ -12,19 +14,55 @@ from .roles.tap_generator import TapGenerator
 from .utils.logs import _logger
 
 
+# 产生这两类消息后，本轮对话结束
+FINAL_ACTIONS = ("AskUser", "Finish")
+
+
+class TurnStats:
+    """一轮对话（一次Environment.run）的调度统计."""
+
+    def __init__(self):
+        self.runs = 0  # 角色运行的总次数
+        self.role_runs: dict[str, int] = {}  # 角色 -> 运行次数
+        self.latency: dict[str, float] = {}  # 角色 -> 累计运行时长（秒）
+        self.timeouts: list[str] = []  # 超时被取消的角色
+        self.cancelled: list[str] = []  # 因本轮已结束而被取消的角色
+        self.elapsed = 0.0  # 本轮总时长（秒）
+        self.stop_reason = ""
+
+    def record(self, profile: str, seconds: float):
+        self.runs += 1
+        self.role_runs[profile] = self.role_runs.get(profile, 0) + 1
+        self.latency[profile] = self.latency.get(profile, 0.0) + seconds
+
+    def to_dict(self):
+        return {
+            "runs": self.runs,
+            "role_runs": self.role_runs,
+            "latency": {k: round(v, 3) for k, v in self.latency.items()},
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "elapsed": round(self.elapsed, 3),
+            "stop_reason": self.stop_reason,
+        }
+
+
 class Environment(BaseModel):
     roles: dict[str, Role] = Field(default_factory=dict)
     memory: Memory = Field(default_factory=Memory)
-    history: str = Field(default="")
+    # 最近发布的消息，超出上限时丢弃最早的消息；需要文本时由history属性拼接
+    recent_messages: deque = Field(default_factory=deque)
     message_cnt: int = Field(default=0)
     devices: list = Field(default_factory=list)
     model_zoo: list = Field(default_factory=list)
+    last_turn_stats: TurnStats | None = Field(default=None)
 
     class Config:
         arbitrary_types_allowed = True
 
-    def __init__(self):
+    def __init__(self, history_size=DEFAULT_ENV_HISTORY_SIZE):
         super().__init__()
+        self.recent_messages = deque(maxlen=history_size)
         self.devices = CONFIG.hass_data["all_context"]
         _logger.debug(f"devices number: {len(self.devices)}")
         self.add_roles(
@@ -42,32 +80,98 @@ class Environment(BaseModel):
             self.add_role(role)
 
     async def publish_message(self, message: Message):
-        """向当前环境发布信息."""
+        """向当前环境发布信息，并投递到每个接收者的邮箱."""
         self.memory.add(message)
-        self.history += f"\n{message}"
+        self.recent_messages.append(message)
         self.message_cnt += 1
+        for recipient in message.send_to:
+            role = self.roles.get(recipient)
+            if role is not None:
+                role.deliver(message)
 
-    async def run(self, k=10) -> tuple[Message, bool]:
-        # 默认允许角色之间对话10轮
+    @property
+    def history(self) -> str:
+        """最近消息的文本记录，每条消息占一行."""
+        return "".join(f"\n{message}" for message in self.recent_messages)
+
+    async def run(
+        self,
+        k=10,
+        turn_timeout=DEFAULT_TURN_TIMEOUT,
+        role_timeout=DEFAULT_ROLE_TIMEOUT,
+    ) -> tuple[Message, bool]:
+        """运行角色直到产生Finish/AskUser消息或没有角色收到新消息.
+
+        每个角色运行结束后立即调度邮箱中有新消息的角色，不等待同一批中的其他角色；
+        k为每个角色在本轮中最多运行的次数，turn_timeout和role_timeout分别限制整轮和单次运行的时长。
+        """
         _logger.info("-----------------run-----------------")
-        current_message_cnt = self.message_cnt
-        for i in range(k):
-            _logger.info(f"-----------------{i}-----------------")
-            # 判断是否有新消息，如果没有则退出
-            if i != 0 and self.message_cnt == current_message_cnt:
-                break  # 一轮中没有任何新消息产生
-
-            current_message_cnt = self.message_cnt
-            futures = []
-            for role_name in self.roles:
-                role = self.roles[role_name]
-                future = role.run()
-                futures.append(future)
-            await asyncio.gather(
-                *futures
-            )  # role.run()方法中await self._publish_message(rsp_message)这一行已经将rsp_message发布到环境中了，所以这里无需关注返回值
-
-        latest_message = self.memory.get_latest_message()
+        loop = asyncio.get_running_loop()
+        stats = TurnStats()
+        start = loop.time()
+        deadline = start + turn_timeout
+        running: dict[asyncio.Task, tuple[Role, float]] = {}
+        final_message = None
+        try:
+            while True:
+                # 只运行邮箱中有新消息、且当前没有在运行的角色
+                busy = {role.profile for role, _ in running.values()}
+                for role in self.roles.values():
+                    if (
+                        role.has_mail
+                        and role.profile not in busy
+                        and stats.role_runs.get(role.profile, 0) < k
+                    ):
+                        _logger.info(f"-----------------{role.profile}-----------------")
+                        task = asyncio.create_task(
+                            asyncio.wait_for(role.run(), role_timeout)
+                        )
+                        running[task] = (role, loop.time())
+                if not running:
+                    # 没有角色收到新消息，或收到新消息的角色都已达到运行次数上限
+                    stats.stop_reason = (
+                        "max_runs"
+                        if any(role.has_mail for role in self.roles.values())
+                        else "idle"
+                    )
+                    break
+                remaining = deadline - loop.time()
+                done = set()
+                if remaining > 0:
+                    done, _ = await asyncio.wait(
+                        running, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                    )
+                if not done:
+                    _logger.warning(f"Turn timed out after {turn_timeout}s.")
+                    stats.stop_reason = "turn_timeout"
+                    break
+                for task in done:
+                    role, started = running.pop(task)
+                    stats.record(role.profile, loop.time() - started)
+                    try:
+                        _, rsp_message = task.result()
+                    except asyncio.TimeoutError:
+                        _logger.warning(f"{role.profile} timed out after {role_timeout}s.")
+                        stats.timeouts.append(role.profile)
+                        continue
+                    # role.run()方法中await self._publish_message(rsp_message)这一行已经将rsp_message发布到环境中了
+                    if isinstance(rsp_message, Message) and rsp_message.cause_by in FINAL_ACTIONS:
+                        final_message = rsp_message
+                if final_message is not None:
+                    stats.stop_reason = final_message.cause_by
+                    break
+        finally:
+            # 本轮已结束（或出错），取消仍在运行的角色
+            for task, (role, _) in running.items():
+                task.cancel()
+                stats.cancelled.append(role.profile)
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            stats.elapsed = loop.time() - start
+            self.last_turn_stats = stats
+            _logger.info(f"turn stats: {stats.to_dict()}")
+
+        latest_message = final_message or self.memory.get_latest_message()
         _logger.info(f"latest_message: {latest_message.to_dict()}")
         if latest_message.cause_by not in ["AskUser", "Finish"]:
             return (
@@ -91,8 +195,9 @@ class Environment(BaseModel):
     def reset(self):
         """重置环境."""
         self.memory = Memory()
-        self.history = ""
+        self.recent_messages.clear()
         self.message_cnt = 0
+        self.last_turn_stats = None
         for key in self.roles:
             role = self.roles[key]
             role.reset()
@@ -0,0 +1,266 @@
+"""本地意图匹配：对控制单个设备的简单命令直接生成设备指令，无需经过Router和DeviceControler."""
+
+import re
+
+from .configs import CONFIG
+from .context_assistant import AREA_ALIASES, area_keywords, match_keywords
+from .utils.logs import _logger
+
+ON_WORDS = ["打开", "开启", "启动", "开一下", "turn on", "switch on", "power on"]
+OFF_WORDS = ["关闭", "关掉", "关上", "关一下", "turn off", "switch off", "power off", "shut down"]
+
+# 请求中出现这些词，说明包含条件、延时、多个动作或提问，交给LLM处理
+COMPLEX_WORDS = [
+    "如果", "假如", "要是", "的话", "之后", "以后", "之前", "分钟", "小时", "秒",
+    "然后", "并且", "同时", "和", "跟", "还有", "再", "自动", "每天", "所有", "全部",
+    "吗", "？", "?", "什么", "多少",
+    "if", "when", "after", "before", "then", "and", "minute", "minutes", "hour", "hours",
+    "until", "unless", "automatically", "every", "all", "what", "how",
+    # 时间：定时执行的命令需要生成自动化，不能立即执行
+    "点", "早", "晚", "今天", "明天", "后天", "中午", "上午", "下午", "凌晨", "半夜",
+    "at", "tomorrow", "tonight", "today", "morning", "afternoon", "evening", "noon", "am", "pm",
+    # 模式、风速、颜色等本地匹配不处理的属性
+    "模式", "制热", "制冷", "除湿", "送风", "睡眠", "风速", "风量", "档", "颜色", "色温", "色",
+    "mode", "heat", "heating", "cool", "cooling", "dry", "speed", "color", "colour",
+    "red", "green", "blue", "yellow", "white", "warm",
+]
+
+# 请求中出现否定词时不做本地匹配，否则“不要打开卧室灯”会被当作打开卧室灯
+NEGATION_WORDS = [
+    "不", "别", "勿", "莫", "没",
+    "don't", "don’t", "dont", "do not", "never", "not", "no",
+]
+
+# 设备类型的中英文名称（只包含设备本身的叫法）
+DEVICE_NOUNS = {
+    "light": ["灯", "light", "lamp"],
+    "air_conditioner": ["空调", "air conditioner", "ac"],
+    "heater": ["取暖器", "加热器", "暖气", "heater"],
+    "humidifier": ["加湿器", "humidifier"],
+    "dehumidifier": ["除湿机", "除湿器", "dehumidifier"],
+    "air_purifier": ["净化器", "air purifier", "purifier"],
+    "fan": ["风扇", "电扇", "fan"],
+    "television": ["电视", "tv", "television"],
+    "speaker": ["音箱", "speaker"],
+    "curtain": ["窗帘", "curtain", "curtains"],
+    "outlet": ["插座", "outlet", "plug", "socket"],
+}
+
+SWITCH_PROPERTIES = ["on", "switch_status", "power"]
+
+BRIGHTNESS_PATTERNS = [
+    re.compile(r"亮度\D{0,4}?(\d{1,3})\s*%?"),
+    re.compile(r"brightness\D{0,8}?(\d{1,3})\s*%?"),
+]
+TEMPERATURE_PATTERNS = [
+    re.compile(r"(\d{2}(?:\.\d)?)\s*(?:度|℃|°)"),
+    re.compile(r"temperature\D{0,8}?(\d{2}(?:\.\d)?)"),
+]
+
+MAX_REQUEST_LENGTH = 40  # 过长的请求通常不是简单命令
+
+# 命令中不影响语义的词，去掉动词、设备、区域、数值和这些词后还有剩余文字时，交给LLM处理
+FILLER_WORDS = [
+    "麻烦", "请", "帮我", "帮忙", "给我", "一下", "把", "将", "的", "调到", "调成", "调为", "调至",
+    "设置为", "设置成", "设置到", "设为", "设成", "设置", "亮度", "温度", "吧", "啊", "呀", "哦",
+    "please", "can you", "could you", "the", "my", "set", "to", "percent", "degrees", "degree",
+    "brightness", "temperature",
+]
+
+
+class IntentMatch:
+    def __init__(self, device: dict, commands: list[str], say_to_user: str):
+        self.device = device
+        self.commands = commands
+        self.say_to_user = say_to_user
+
+
+def _is_chinese(text: str) -> bool:
+    return any("一" <= ch <= "鿿" for ch in text)
+
+
+def _mentioned_areas(request: str, all_context: list[dict]) -> set[str]:
+    """请求中提到的区域，包括家中没有设备的常见区域."""
+    areas = set(AREA_ALIASES) | {str(device.get("area", "")).lower() for device in all_context}
+    return {
+        area
+        for area in areas
+        if match_keywords(request, area_keywords({"area": area}))
+    }
+
+
+def _find_device(request: str) -> dict | None:
+    """找到请求所指的唯一设备：优先按设备名称，其次按设备类型（同类设备不唯一时需要区域区分）.
+
+    请求中提到了区域、而设备不在其中任何一个区域时不匹配。
+    """
+    all_context = CONFIG.hass_data.get("all_context", [])
+    device = _find_candidate(request, all_context)
+    if device is None:
+        return None
+    areas = _mentioned_areas(request, all_context)
+    if areas and str(device.get("area", "")).lower() not in areas:
+        return None
+    return device
+
+
+def _find_candidate(request: str, all_context: list[dict]) -> dict | None:
+    by_name = [
+        device
+        for device in all_context
+        if device.get("name") and str(device["name"]).lower() in request
+    ]
+    if len(by_name) == 1:
+        return by_name[0]
+    if by_name:
+        return None
+
+    by_type = [
+        device
+        for device in all_context
+        if match_keywords(request, DEVICE_NOUNS.get(device.get("type"), []))
+    ]
+    if len(by_type) == 1:
+        return by_type[0]
+    by_area = [device for device in by_type if match_keywords(request, area_keywords(device))]
+    if len(by_area) == 1:
+        return by_area[0]
+    return None
+
+
+def _find_property(device: dict, names: list[str]) -> tuple[str, dict] | None:
+    """在设备的服务中查找属性，优先查找与设备类型同名的服务，返回(service.property, 属性信息)."""
+    services = device.get("services", {})
+    ordered = sorted(services.items(), key=lambda item: item[0] != device.get("type"))
+    for name in names:
+        for service_name, service in ordered:
+            if name in service:
+                return f"{service_name}.{name}", service[name]
+    return None
+
+
+def _writable(property: dict) -> bool:
+    return "write" in property.get("access", [])
+
+
+def _scale_percent(percent: int, property: dict):
+    """将百分比换算为属性的取值范围."""
+    value_range = property.get("value-range")
+    if not value_range:
+        return percent
+    low, high = value_range[0], value_range[1]
+    if high <= 100:
+        return max(low, min(high, percent))
+    return round(low + (high - low) * percent / 100)
+
+
+def _strip_words(text: str, words: list[str]) -> str:
+    """按给定的顺序从文本中去掉这些词，英文词按整词去掉."""
+    for word in words:
+        if word.isascii():
+            text = re.sub(rf"(?<![a-z0-9]){re.escape(word)}(?![a-z0-9])", " ", text)
+        else:
+            text = text.replace(word, " ")
+    return text
+
+
+def _has_leftover(text: str, device: dict, values: list[re.Match]) -> bool:
+    """去掉动词、设备、区域、数值和无关的词后是否还有剩余文字."""
+    for match in values:
+        text = text.replace(match.group(0), " ")
+    # 动词按列表顺序去掉，“打开一下”先去掉“打开”，剩下的“一下”作为无关的词去掉
+    text = _strip_words(text, ON_WORDS + OFF_WORDS)
+    words = FILLER_WORDS + [noun for nouns in DEVICE_NOUNS.values() for noun in nouns]
+    words += area_keywords(device)
+    if device.get("name"):
+        words.append(str(device["name"]).lower())
+    text = _strip_words(text, sorted(set(words), key=len, reverse=True))
+    return bool(re.sub(r"[\s\W_]+", "", text))
+
+
+def _percent_of(value, property: dict) -> int:
+    """将属性值换算回百分比，用于回复用户."""
+    value_range = property.get("value-range")
+    if not value_range or value_range[1] <= 100:
+        return value
+    low, high = value_range[0], value_range[1]
+    return round((value - low) * 100 / (high - low))
+
+
+def match_intent(request: str) -> IntentMatch | None:
+    """匹配控制单个设备的简单命令，匹配不够确定时返回None，由LLM处理."""
+    text = request.strip().lower()
+    if (
+        not text
+        or len(text) > MAX_REQUEST_LENGTH
+        or match_keywords(text, COMPLEX_WORDS)
+        or match_keywords(text, NEGATION_WORDS)
+    ):
+        return None
+
+    turn_on = match_keywords(text, ON_WORDS)
+    turn_off = match_keywords(text, OFF_WORDS)
+    if turn_on and turn_off:
+        return None
+    brightness = next((m for p in BRIGHTNESS_PATTERNS if (m := p.search(text))), None)
+    temperature = next((m for p in TEMPERATURE_PATTERNS if (m := p.search(text))), None)
+    if turn_off and (brightness or temperature):
+        return None
+    if not (turn_on or turn_off or brightness or temperature):
+        return None
+
+    device = _find_device(text)
+    if device is None:
+        return None
+    if _has_leftover(text, device, [m for m in (brightness, temperature) if m]):
+        return None
+    device_id = device["id"]
+    commands = []
+    actions_zh, actions_en = [], []
+
+    if turn_on or turn_off:
+        found = _find_property(device, SWITCH_PROPERTIES)
+        if found is None or not _writable(found[1]) or found[1].get("format") != "bool":
+            return None
+        commands.append(f"{device_id}.{found[0]} = {'true' if turn_on else 'false'}")
+        actions_zh.append("打开" if turn_on else "关闭")
+        actions_en.append("turned on" if turn_on else "turned off")
+
+    if brightness:
+        found = _find_property(device, ["brightness"])
+        percent = int(brightness.group(1))
+        if found is None or not _writable(found[1]) or percent > 100:
+            return None
+        value = _scale_percent(percent, found[1])
+        commands.append(f"{device_id}.{found[0]} = {value}")
+        # 回复使用实际设置的值，超出取值范围的百分比已被限制在范围内
+        percent = _percent_of(value, found[1])
+        actions_zh.append(f"亮度调到{percent}%")
+        actions_en.append(f"brightness set to {percent}%")
+
+    if temperature:
+        value = float(temperature.group(1))
+        found = _find_property(device, ["target_temperature"])
+        if found is None or not _writable(found[1]):
+            return None
+        field, property = found
+        if device.get("type") == "air_conditioner":
+            # 与DeviceControler一致，空调温度使用固定的指令格式
+            field = "air_conditioner.target_temperature"
+        value_range = property.get("value-range")
+        if value_range and not value_range[0] <= value <= value_range[1]:
+            return None
+        value_str = str(int(value)) if value.is_integer() else str(value)
+        commands.append(f"{device_id}.{field} = {value_str}")
+        actions_zh.append(f"温度调到{value_str}度")
+        actions_en.append(f"temperature set to {value_str}")
+
+    name = device.get("name") or device.get("type")
+    if _is_chinese(request):
+        say_to_user = f"好的，已为您将{name}{'，'.join(actions_zh)}。"
+        if actions_zh == ["打开"] or actions_zh == ["关闭"]:
+            say_to_user = f"好的，已为您{actions_zh[0]}{name}。"
+    else:
+        say_to_user = f"OK, {name} {', '.join(actions_en)}."
+    _logger.info(f"Intent matched: {request} -> {commands}")
+    return IntentMatch(device, commands, say_to_user)
@@ -1,8 +1,22 @@
+from .catalog import estimate_tokens
 from .configs import CONFIG
+from .const import (
+    CONF_MAX_CONNECTIONS,
+    CONF_MAX_KEEPALIVE_CONNECTIONS,
+    CONF_REQUEST_TIMEOUT,
+    DEFAULT_HISTORY_TOKEN_BUDGET,
+    DEFAULT_OBSERVATION_SUMMARY_CHARS,
+    DEFAULT_KEEPALIVE_EXPIRY,
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+    DEFAULT_REQUEST_TIMEOUT,
+)
 from .utils.logs import _logger
 from .utils.singleton import Singleton
+from collections.abc import Callable
+from types import SimpleNamespace
 from typing import NamedTuple
-from openai import OpenAI
+from openai import AsyncOpenAI, BadRequestError, OpenAI
 from tenacity import retry, stop_after_attempt
 import httpx
 
@@ -19,23 +33,29 @@ class Costs(NamedTuple):
     total_prompt_tokens: int
     total_completion_tokens: int
     total_cost: float
+    total_cached_tokens: int = 0
 
 
 class CostManager(metaclass=Singleton):
     def __init__(self):
         self.total_prompt_tokens = 0
         self.total_completion_tokens = 0
+        self.total_cached_tokens = 0  # 命中服务商提示词缓存的输入token数
         self.total_cost = 0.0
 
-    def update_cost(self, completion_tokens, prompt_tokens, cost):
+    def update_cost(self, completion_tokens, prompt_tokens, cost, cached_tokens=0):
         self.total_prompt_tokens += prompt_tokens
         self.total_completion_tokens += completion_tokens
+        self.total_cached_tokens += cached_tokens
         self.total_cost += cost
         CONFIG.total_cost = self.total_cost
 
     def get_total_prompt_tokens(self):
         return self.total_prompt_tokens
 
+    def get_total_cached_tokens(self):
+        return self.total_cached_tokens
+
     def get_total_completion_tokens(self):
         return self.total_completion_tokens
 
@@ -45,33 +65,160 @@ class CostManager(metaclass=Singleton):
     @property
     def costs(self):
         return Costs(
-            self.total_prompt_tokens, self.total_completion_tokens, self.total_cost
+            self.total_prompt_tokens,
+            self.total_completion_tokens,
+            self.total_cost,
+            self.total_cached_tokens,
+        )
+
+
+# 所有LLM实例共享的异步客户端，按(base_url, api_key)区分，复用同一个keep-alive连接池
+_ASYNC_CLIENTS: dict[tuple[str, str], AsyncOpenAI] = {}
+
+
+def get_async_client() -> AsyncOpenAI:
+    """获取共享的AsyncOpenAI客户端，不存在时创建."""
+    base_url = CONFIG.configs_llm["base_url"]
+    api_key = CONFIG.configs_llm["api_key"]
+    client = _ASYNC_CLIENTS.get((base_url, api_key))
+    if client is None:
+        limits = httpx.Limits(
+            max_connections=int(
+                CONFIG.configs_llm.get(CONF_MAX_CONNECTIONS, DEFAULT_MAX_CONNECTIONS)
+            ),
+            max_keepalive_connections=int(
+                CONFIG.configs_llm.get(
+                    CONF_MAX_KEEPALIVE_CONNECTIONS, DEFAULT_MAX_KEEPALIVE_CONNECTIONS
+                )
+            ),
+            keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY,
+        )
+        timeout = float(
+            CONFIG.configs_llm.get(CONF_REQUEST_TIMEOUT, DEFAULT_REQUEST_TIMEOUT)
         )
+        client = AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                base_url=base_url,
+                follow_redirects=True,
+                limits=limits,
+                timeout=timeout,
+            ),
+        )
+        _ASYNC_CLIENTS[(base_url, api_key)] = client
+        _logger.debug(f"Create shared async LLM client: {base_url}, {limits}")
+    return client
+
+
+# 不支持stream_options={"include_usage": True}的服务商（按base_url），之后的流式调用不再发送该参数
+_STREAM_USAGE_UNSUPPORTED: set[str] = set()
+
+
+async def close_async_clients():
+    """关闭所有共享的异步客户端（卸载集成时调用）."""
+    for client in _ASYNC_CLIENTS.values():
+        await client.close()
+    _ASYNC_CLIENTS.clear()
+
+
+def get_cached_tokens(usage) -> int:
+    """从usage中读取命中提示词缓存的token数，兼容OpenAI和DeepSeek的字段."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return int(cached or 0)
+
+
+def summarize_observation(text: str, max_chars=DEFAULT_OBSERVATION_SUMMARY_CHARS) -> str:
+    """截断较早的工具返回信息，只保留开头部分."""
+    text = str(text)
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + "……（较早的工具返回信息，其余内容已省略）"
 
 
 class LLM:
-    def __init__(self):
+    def __init__(self, history_token_budget=DEFAULT_HISTORY_TOKEN_BUDGET):
         self._cost_manager = CostManager()
         self.total_completion_tokens = 0
         self.total_prompt_tokens = 0
+        self.total_cached_tokens = 0
         self.total_cost = 0.0
         self.model = CONFIG.configs_llm["provider"]
         self.temperature = CONFIG.configs_llm["temperature"]
         self.max_tokens = int(CONFIG.configs_llm["max_tokens"])
         self.sysmsg_added: bool = False
-        self._init_client()
+        self.client: OpenAI | None = None  # 同步客户端仅在调用同步接口时创建
         self.history = []
+        # 与history一一对应的(kind, summary)：超出token预算时，同一kind较早的消息以summary代替
+        self.history_meta: list[tuple[str | None, str | None]] = []
+        self.history_token_budget = history_token_budget
         _logger.debug(f"configs_llm: {CONFIG.configs_llm}")
 
     def add_system_msg(self, msg):
         self.history.append({"role": "system", "content": msg})
+        self.history_meta.append((None, None))
         self.sysmsg_added = True
 
-    def add_user_msg(self, msg):
+    def add_user_msg(self, msg, summary=None, kind=None):
+        """添加用户消息.
+
+        历史超出token预算时，kind相同的消息中较早的以summary代替，最新的一条始终完整发送
+        （例如每轮都附带的设备列表只保留最新的一份，较早的工具返回信息只保留摘要）。
+        """
         self.history.append({"role": "user", "content": msg})
+        self.history_meta.append((kind, summary))
 
     def add_assistant_msg(self, msg):
         self.history.append({"role": "assistant", "content": msg})
+        self.history_meta.append((None, None))
+
+    def get_messages(self) -> list[dict]:
+        """生成发送给LLM的消息，超出token预算时先将较早的同类消息换成摘要，仍超出时从最早的对话开始丢弃.
+
+        系统消息、每种kind最新的消息和最后一条消息始终保留。换成摘要的消息直接写回history，
+        之后的调用原样发送，保证各轮之间提示词的前缀不变，可以命中服务商的提示词缓存。
+        """
+        costs = [estimate_tokens(str(message["content"])) for message in self.history]
+        total = sum(costs)
+        if total <= self.history_token_budget:
+            return list(self.history)
+
+        latest = {}
+        for i, (kind, _) in enumerate(self.history_meta):
+            if kind is not None:
+                latest[kind] = i
+        for i, (kind, summary) in enumerate(self.history_meta):
+            if total <= self.history_token_budget:
+                break
+            if summary is None or latest[kind] == i:
+                continue
+            self.history[i] = {"role": self.history[i]["role"], "content": summary}
+            self.history_meta[i] = (kind, None)
+            cost = estimate_tokens(summary)
+            total -= costs[i] - cost
+            costs[i] = cost
+        if total <= self.history_token_budget:
+            _logger.debug(f"history summarized to {total} tokens")
+            return list(self.history)
+
+        protected = set(latest.values()) | {len(self.history) - 1}
+        keep = [True] * len(self.history)
+        for i, message in enumerate(self.history):
+            if total <= self.history_token_budget:
+                break
+            if i in protected or message["role"] == "system":
+                continue
+            keep[i] = False
+            total -= costs[i]
+        _logger.debug(f"history trimmed to {total} tokens, dropped {keep.count(False)} messages")
+        return [message for message, kept in zip(self.history, keep) if kept]
+
+    @property
+    def aclient(self) -> AsyncOpenAI:
+        return get_async_client()
 
     def _init_client(self):
         self.client = OpenAI(
@@ -84,6 +231,8 @@ class LLM:
 
     @retry(stop=stop_after_attempt(6))
     def chat_completion_json_v1(self, messages: list[dict]) -> dict:
+        if self.client is None:
+            self._init_client()
         response = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
@@ -92,25 +241,13 @@ class LLM:
             response_format={"type": "json_object"},
         )
         _logger.debug(f"response: {response}")
-        rsp = response.choices[0].message.content
-        usage = response.usage
-        completion_tokens = usage.completion_tokens
-        prompt_tokens = usage.prompt_tokens
-        cost = round(
-            (
-                completion_tokens * prices[self.model][0]
-                + prompt_tokens * prices[self.model][1]
-            )
-            * 7.15
-            / 1e6,
-            6,
-        )
-        self._cost_manager.update_cost(completion_tokens, prompt_tokens, cost)
-        self._update_llm_cost(completion_tokens, prompt_tokens, cost)
-        return rsp
+        self._record_usage(response.usage)
+        return response.choices[0].message.content
 
     @retry(stop=stop_after_attempt(6))
     def chat_completion_text_v1(self, messages: list[dict]) -> dict:
+        if self.client is None:
+            self._init_client()
         response = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
@@ -118,8 +255,106 @@ class LLM:
             max_tokens=self.max_tokens,
         )
         _logger.debug(f"response: {response}")
-        rsp = response.choices[0].message.content
-        usage = response.usage
+        self._record_usage(response.usage)
+        return response.choices[0].message.content
+
+    @retry(stop=stop_after_attempt(6))
+    async def async_chat_completion_json_v1(self, messages: list[dict]) -> str:
+        """chat_completion_json_v1的原生异步版本，使用共享连接池，不占用执行器线程."""
+        response = await self.aclient.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            response_format={"type": "json_object"},
+        )
+        _logger.debug(f"response: {response}")
+        self._record_usage(response.usage)
+        return response.choices[0].message.content
+
+    @retry(stop=stop_after_attempt(6))
+    async def async_chat_completion_text_v1(self, messages: list[dict]) -> str:
+        """chat_completion_text_v1的原生异步版本，使用共享连接池，不占用执行器线程."""
+        response = await self.aclient.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+        )
+        _logger.debug(f"response: {response}")
+        self._record_usage(response.usage)
+        return response.choices[0].message.content
+
+    async def async_chat_completion_stream_v1(
+        self,
+        messages: list[dict],
+        on_text: Callable[[str], None] | None = None,
+        json_mode: bool = False,
+    ) -> str:
+        """流式调用LLM，每收到一段增量内容就用目前为止的完整文本调用on_text，返回完整回复.
+
+        若在收到任何内容之前出错，退回到非流式调用；已经开始输出后出错则直接抛出，避免重复推送。
+        """
+        kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+        base_url = CONFIG.configs_llm["base_url"]
+        if base_url not in _STREAM_USAGE_UNSUPPORTED:
+            kwargs["stream_options"] = {"include_usage": True}
+        rsp = ""
+        usage = None
+        chunks = 0
+        try:
+            try:
+                stream = await self._create_stream(messages, kwargs)
+            except BadRequestError:
+                if "stream_options" not in kwargs:
+                    raise
+                # 去掉include_usage后请求成功，说明服务商不支持该参数，之后的调用都不再发送
+                kwargs.pop("stream_options")
+                stream = await self._create_stream(messages, kwargs)
+                _logger.info(f"{base_url} does not support stream_options, disable it.")
+                _STREAM_USAGE_UNSUPPORTED.add(base_url)
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                rsp += delta
+                chunks += 1
+                if on_text is not None:
+                    on_text(rsp)
+        except Exception as ex:
+            if rsp:
+                raise
+            _logger.warning(f"Streaming failed, fall back to non-streaming: {ex!r}")
+            if json_mode:
+                return await self.async_chat_completion_json_v1(messages)
+            return await self.async_chat_completion_text_v1(messages)
+
+        _logger.debug(f"streamed response: {rsp}")
+        if usage is None:
+            # 部分服务商不支持include_usage，此时按增量块数和字符数粗略估算
+            usage = SimpleNamespace(
+                completion_tokens=chunks,
+                prompt_tokens=sum(len(str(m["content"])) for m in messages) // 2,
+            )
+        self._record_usage(usage)
+        return rsp
+
+    async def _create_stream(self, messages: list[dict], kwargs: dict):
+        return await self.aclient.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stream=True,
+            **kwargs,
+        )
+
+    def _record_usage(self, usage):
+        """根据response.usage计算费用并累计到CostManager和当前LLM."""
         completion_tokens = usage.completion_tokens
         prompt_tokens = usage.prompt_tokens
         cost = round(
@@ -131,19 +366,24 @@ class LLM:
             / 1e6,
             6,
         )
-        self._cost_manager.update_cost(completion_tokens, prompt_tokens, cost)
-        self._update_llm_cost(completion_tokens, prompt_tokens, cost)
-        return rsp
+        cached_tokens = get_cached_tokens(usage)
+        if cached_tokens:
+            _logger.debug(f"cached prompt tokens: {cached_tokens}/{prompt_tokens}")
+        self._cost_manager.update_cost(completion_tokens, prompt_tokens, cost, cached_tokens)
+        self._update_llm_cost(completion_tokens, prompt_tokens, cost, cached_tokens)
 
-    def _update_llm_cost(self, completion_tokens, prompt_tokens, cost):
+    def _update_llm_cost(self, completion_tokens, prompt_tokens, cost, cached_tokens=0):
         self.total_completion_tokens += completion_tokens
         self.total_prompt_tokens += prompt_tokens
+        self.total_cached_tokens += cached_tokens
         self.total_cost += cost
 
     def reset(self):
         self.history = []
+        self.history_meta = []
         self.total_completion_tokens = 0
         self.total_prompt_tokens = 0
+        self.total_cached_tokens = 0
         self.total_cost = 0.0
         self.model = CONFIG.configs_llm["provider"]
         self.sysmsg_added = False
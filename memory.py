@@ -5,18 +5,40 @@ from .message import Message
 class Memory:
     def __init__(self):
         self.storage: list[Message] = []
-        self.index: dict[str, list[Message]] = defaultdict(list)
+        # 以下索引与storage同步维护，查询时无需遍历storage
+        self.ids: dict[str, Message] = {}
+        self.index: dict[str, list[Message]] = defaultdict(list)  # cause_by -> messages
+        self.role_index: dict[str, list[Message]] = defaultdict(list)
+        self.recipient_index: dict[str, list[Message]] = defaultdict(list)
+
+    def __contains__(self, message: Message) -> bool:
+        return message.id in self.ids
+
+    def __len__(self) -> int:
+        return len(self.storage)
 
     def add(self, message: Message):
-        if message in self.storage:
+        if message.id in self.ids:
             return
         self.storage.append(message)
+        self.ids[message.id] = message
         if message.cause_by:
             self.index[message.cause_by].append(message)
+        self.role_index[message.role].append(message)
+        for recipient in message.send_to:
+            self.recipient_index[recipient].append(message)
+
+    def get_by_id(self, message_id: str) -> Message | None:
+        """Return the message with the specified id"""
+        return self.ids.get(message_id)
 
     def get_by_role(self, role: str) -> list[Message]:
         """Return all messages of a specified role"""
-        return [message for message in self.storage if message.role == role]
+        return self.role_index.get(role, [])
+
+    def get_by_recipient(self, recipient: str) -> list[Message]:
+        """Return all messages sent to a specified recipient"""
+        return self.recipient_index.get(recipient, [])
 
     def get_by_content(self, content: str) -> list[Message]:
         """Return all messages containing a specified content"""
@@ -24,14 +46,23 @@ class Memory:
 
     def delete(self, message: Message):
         """Delete the specified message from storage, while updating the index"""
+        message = self.ids.pop(message.id, None)
+        if message is None:
+            return
         self.storage.remove(message)
-        if message.cause_by and message in self.index[message.cause_by]:
+        if message.cause_by:
             self.index[message.cause_by].remove(message)
+        self.role_index[message.role].remove(message)
+        for recipient in message.send_to:
+            self.recipient_index[recipient].remove(message)
 
     def clear(self):
         """Clear storage and index"""
         self.storage = []
+        self.ids = {}
         self.index = defaultdict(list)
+        self.role_index = defaultdict(list)
+        self.recipient_index = defaultdict(list)
 
     def remember_by_keyword(self, keyword: str) -> list[Message]:
         """Try to recall all messages containing a specified keyword"""
@@ -49,24 +80,20 @@ class Memory:
         """Return the most recent k memories, return all when k=0"""
         return self.storage[-k:]
 
-    def find_news(self, obsereved: list[Message], k=10) -> list[Message]:
-        """Try to find new messages from the observed messages"""
-        already_remembered = self.get(k)
-        news = []
-        for message in obsereved:
-            if (
-                message not in already_remembered
-            ):  # 李安：如果message不在already_remembered中，说明是新消息，将其加入news列表
-                news.append(message)
-        return news  # 李安：返回news列表
+    def find_news(self, obsereved: list[Message], k=0) -> list[Message]:
+        """Try to find new messages from the observed messages.
+
+        按id判断消息是否已在记忆中；k仅为兼容旧的调用方式保留，已不再限制比较的范围。
+        """
+        return [message for message in obsereved if message.id not in self.ids]
 
     def get_by_action(self, action: str) -> list[Message]:
         """Return all messages triggered by a specified Action"""
-        return self.index[action]
+        return self.index.get(action, [])
 
     def get_by_actions(self, actions: list[str]) -> list[Message]:
         """Return all messages triggered by any specified Actions"""
-        return [message for action in actions for message in self.index[action]]
+        return [message for action in actions for message in self.index.get(action, [])]
 
     def get_latest_message(self) -> Message:
         """Return the latest message"""
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional
+from uuid import uuid4
 
 
 class Message(BaseModel):
@@ -9,10 +10,15 @@ class Message(BaseModel):
     sent_from: str
     send_to: list  # 明确类型，send_to 是一个字符串列表
     attachment: Optional["Message"] = None  # 允许附加另一个 Message
+    # 消息的唯一标识，Memory按id去重和建立索引，内容相同的两条消息也不会被当作同一条
+    id: str = Field(default_factory=lambda: uuid4().hex)
 
     def __str__(self):
         return f"{self.content}"
 
+    def __hash__(self):
+        return hash(self.id)
+
     def to_dict(self):
         return {
             "role": self.role,
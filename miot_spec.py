@@ -0,0 +1,295 @@
+"""MIoT设备规格（miot-spec.org）的异步下载与持久化缓存.
+
+缓存位于DATA_PATH/cache/miot，与每次启动时清空的temp目录分开，HA重启后无需重新下载。
+每个URL的ETag、Last-Modified和获取时间记录在meta.json中：未超过max_age的缓存直接使用，
+超过后带条件请求向服务器确认，服务器返回304时继续使用缓存；服务器不可用时退回到已有的缓存。
+"""
+
+import asyncio
+import codecs
+import json
+import os
+import shutil
+import time
+
+import aiohttp
+
+from .configs import CONFIG
+from .const import (
+    DATA_PATH,
+    DEFAULT_SPEC_CACHE_MAX_AGE,
+    DEFAULT_SPEC_FETCH_CONCURRENCY,
+    DEFAULT_SPEC_FETCH_TIMEOUT,
+)
+from .utils.logs import _logger
+
+SPEC_CACHE_PATH = f"{DATA_PATH}/cache/miot"
+SPEC_CACHE_VERSION = 2  # 缓存格式变化时递增，旧版本的缓存会被整体丢弃
+
+INSTANCES_URL = "http://miot-spec.org/miot-spec-v2/instances?status=all"
+SPEC_URL = "http://miot-spec.org/miot-spec-v2/instance?type={miot_type}"
+
+
+def _read_json(file_path: str):
+    with open(file_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_json(file_path: str, data):
+    """先写入临时文件再替换，避免中断时留下不完整的缓存文件."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, file_path)
+
+
+class InstanceStreamParser:
+    """增量解析instances列表：逐块输入响应文本，每解析出一个完整的instance对象就返回它，
+    整个文档不会被完整地保存在内存中.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._in_array = False
+        self._done = False
+
+    def feed(self, chunk: bytes) -> list[dict]:
+        if self._done:
+            return []
+        self._buffer += self._utf8.decode(chunk)
+        if not self._in_array:
+            key = self._buffer.find('"instances"')
+            start = self._buffer.find("[", key) if key != -1 else -1
+            if start == -1:
+                return []
+            self._buffer = self._buffer[start + 1 :]
+            self._in_array = True
+
+        instances = []
+        pos = 0
+        while True:
+            while pos < len(self._buffer) and self._buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(self._buffer):
+                break
+            if self._buffer[pos] == "]":
+                self._done = True
+                break
+            try:
+                instance, pos = self._decoder.raw_decode(self._buffer, pos)
+            except ValueError:
+                break  # 对象还不完整，等待下一块数据
+            instances.append(instance)
+        self._buffer = "" if self._done else self._buffer[pos:]
+        return instances
+
+
+async def _run_in_executor(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+class SpecCache:
+    """按URL缓存miot-spec.org的响应，文件名由调用方指定."""
+
+    def __init__(self, path=SPEC_CACHE_PATH, max_age=DEFAULT_SPEC_CACHE_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.meta_path = f"{path}/meta.json"
+        # 缓存文件名 -> {"url", "etag", "last_modified", "fetched_at"}
+        self.entries: dict[str, dict] = {}
+
+    def load(self):
+        """读取meta.json，版本不一致时清空整个缓存目录."""
+        meta = None
+        if os.path.exists(self.meta_path):
+            try:
+                meta = _read_json(self.meta_path)
+            except (OSError, ValueError) as ex:
+                _logger.warning(f"Failed to load MIoT spec cache meta: {ex!r}")
+        if meta is None or meta.get("version") != SPEC_CACHE_VERSION:
+            if os.path.exists(self.path):
+                shutil.rmtree(self.path, ignore_errors=True)
+            meta = {"version": SPEC_CACHE_VERSION, "entries": {}}
+        self.entries = meta["entries"]
+
+    def save(self):
+        _write_json(self.meta_path, {"version": SPEC_CACHE_VERSION, "entries": self.entries})
+
+    def file_path(self, name: str) -> str:
+        return f"{self.path}/{name}"
+
+    def fresh(self, name: str) -> bool:
+        entry = self.entries.get(name)
+        return (
+            entry is not None
+            and os.path.exists(self.file_path(name))
+            and time.time() - entry["fetched_at"] < self.max_age
+        )
+
+    def validators(self, name: str, url: str) -> dict:
+        """已有缓存时返回条件请求头."""
+        entry = self.entries.get(name)
+        if entry is None or entry["url"] != url or not os.path.exists(self.file_path(name)):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def touch(self, name: str):
+        self.entries[name]["fetched_at"] = time.time()
+
+    def record(self, name: str, url: str, response: aiohttp.ClientResponse):
+        self.entries[name] = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+
+
+async def _read_response_json(response: aiohttp.ClientResponse):
+    return await response.json(content_type=None)
+
+
+async def fetch_cached_json(
+    session: aiohttp.ClientSession,
+    cache: SpecCache,
+    url: str,
+    name: str,
+    parse=_read_response_json,
+) -> tuple[dict | None, bool]:
+    """获取URL对应的JSON，返回(数据, 是否从服务器获取了新内容).
+
+    parse将响应转换为需要缓存的数据，默认缓存完整的JSON；结果为空时不缓存，视为获取失败。
+    """
+    file_path = cache.file_path(name)
+    if cache.fresh(name):
+        data = await _run_in_executor(_read_json, file_path)
+        if data:
+            return data, False
+        # 旧版本可能缓存了空结果，重新获取
+
+    try:
+        async with session.get(
+            url,
+            headers=cache.validators(name, url),
+            timeout=aiohttp.ClientTimeout(total=DEFAULT_SPEC_FETCH_TIMEOUT),
+        ) as response:
+            if response.status == 304:
+                cache.touch(name)
+                return await _run_in_executor(_read_json, file_path), False
+            response.raise_for_status()
+            data = await parse(response)
+            if not data:
+                # 例如instances列表缺失时解析结果为空，不缓存，按获取失败处理
+                raise ValueError("empty response")
+            await _run_in_executor(_write_json, file_path, data)
+            cache.record(name, url, response)
+            return data, True
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+        if os.path.exists(file_path):
+            data = await _run_in_executor(_read_json, file_path)
+            if data:
+                _logger.warning(f"Failed to fetch {url}, use cached copy: {ex!r}")
+                return data, False
+        _logger.error(f"Failed to fetch {url}: {ex!r}")
+        return None, False
+
+
+def convert_spec_to_info(spec: dict) -> dict:
+    device_type = spec["type"].split(":")[3]
+    device_type = device_type.replace("-", "_")
+    info = {"type": device_type, "services": {}}
+    for service in spec["services"][1:]:
+        service_type = service["type"].split(":")[3]
+        service_type = service_type.replace("-", "_")
+        service_obj = {}
+        for property in service.get("properties", []):
+            property_type = property["type"].split(":")[3]
+            property_type = property_type.replace("-", "_")
+            property_value = {
+                k: v for k, v in property.items() if k not in ["iid", "type"]
+            }
+            if property_value.get("access", []) != []:
+                service_obj[property_type] = property_value
+        info["services"][service_type] = service_obj
+        if info["services"][service_type] == {}:
+            info["services"].pop(service_type)
+    return info
+
+
+def info_path(model: str) -> str:
+    """设备型号对应的info文件（convert_spec_to_info的结果）."""
+    return f"{SPEC_CACHE_PATH}/info/{model}.json"
+
+
+async def _parse_model_type(response: aiohttp.ClientResponse) -> dict:
+    """边下载边解析instances列表，只保留型号到MIoT类型的映射."""
+    parser = InstanceStreamParser()
+    model_type = {}
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        for instance in parser.feed(chunk):
+            model = instance.get("model")
+            if model and model not in model_type:
+                model_type[model] = instance["type"]
+    return model_type
+
+
+async def download_instance(session: aiohttp.ClientSession, cache: SpecCache):
+    """获取型号到MIoT类型的映射，存入CONFIG.hass_data["model_type"].
+
+    instances列表有数十MB，只缓存由它得到的映射，服务器上的列表没有变化时（304）直接使用缓存的映射。
+    """
+    model_type, _ = await fetch_cached_json(
+        session, cache, INSTANCES_URL, "model_type.json", parse=_parse_model_type
+    )
+    CONFIG.hass_data["model_type"] = model_type or {}
+
+
+async def _update_info(
+    session: aiohttp.ClientSession,
+    cache: SpecCache,
+    semaphore: asyncio.Semaphore,
+    model: str,
+):
+    miot_type = CONFIG.hass_data["model_type"].get(model)
+    if miot_type is None:
+        _logger.error(f"Model {model} not found.")
+        return
+    async with semaphore:
+        spec, updated = await fetch_cached_json(
+            session, cache, SPEC_URL.format(miot_type=miot_type), f"spec/{model}.json"
+        )
+    if spec is None:
+        return
+    if updated or not os.path.exists(info_path(model)):
+        await _run_in_executor(_write_json, info_path(model), convert_spec_to_info(spec))
+
+
+async def get_miot_info(session: aiohttp.ClientSession | None = None):
+    """并发获取所有设备型号的规格，并转换为info文件.
+
+    session为None时创建临时会话；在HA中应传入共享的会话（async_get_clientsession）。
+    """
+    cache = SpecCache()
+    await _run_in_executor(cache.load)
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession()
+    try:
+        await download_instance(session, cache)
+        semaphore = asyncio.Semaphore(DEFAULT_SPEC_FETCH_CONCURRENCY)
+        models = {device["model"] for device in CONFIG.hass_data["miot_devices"]}
+        await asyncio.gather(
+            *(_update_info(session, cache, semaphore, model) for model in models)
+        )
+    finally:
+        if own_session:
+            await session.close()
+        await _run_in_executor(cache.save)
@@ -0,0 +1,99 @@
+"""预取：请求中出现环境相关的词时，在Router分解任务的同时提前调用天气等无需参数的工具.
+
+预取的结果只在本轮请求中有效，Agent调用同名工具时直接使用，不必等待工具返回；
+DeviceControler还会把已经完成的预取结果单独放入用户消息中，省去一次调用工具的LLM往返。
+"""
+
+import asyncio
+from contextvars import ContextVar
+
+from .context_assistant import match_keywords
+from .tool_agent import tool_agent, weather_tool_agent
+from .utils.logs import _logger
+
+# 请求中出现这些词时，预取天气信息
+WEATHER_CUES = [
+    "天气", "气温", "下雨", "降雨", "下雪", "晴", "阴天", "寒冷", "炎热", "刮风", "大风",
+    "日出", "日落", "空气质量", "紫外线", "出门", "带伞",
+    "weather", "rain", "rains", "raining", "snow", "snowing", "sunny", "cloudy", "windy",
+    "sunrise", "sunset", "umbrella",
+]
+
+# 这些词也常用于室内设备（加湿器、空调风速等），只有同时提到室外时才预取天气信息
+INDOOR_AMBIGUOUS_CUES = [
+    "湿度", "潮湿", "干燥", "风速", "降温", "升温", "温度",
+    "humid", "humidity", "dry", "wind", "temperature",
+]
+OUTDOOR_CUES = ["室外", "户外", "外面", "外边", "outdoor", "outdoors", "outside"]
+
+
+def has_cue(request: str, cues: list[str]) -> bool:
+    """英文线索按整词匹配，避免humidifier、train等词误触发."""
+    return match_keywords(request.lower(), cues)
+
+
+class Prefetch:
+    """一轮请求中预取的工具结果，工具名称 -> 正在运行或已完成的任务."""
+
+    def __init__(self):
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    def start(self, tool: tool_agent):
+        if tool.profile not in self.tasks:
+            self.tasks[tool.profile] = asyncio.create_task(tool.run(None))
+
+    async def get(self, profile: str) -> str | None:
+        """等待并返回预取的结果；没有预取或预取失败时返回None."""
+        task = self.tasks.get(profile)
+        if task is None:
+            return None
+        try:
+            return f"{await asyncio.shield(task)}"
+        except Exception as ex:  # noqa: BLE001
+            _logger.warning(f"Prefetch {profile} failed: {ex!r}")
+            return None
+
+    def ready(self) -> dict[str, str]:
+        """已经成功完成的预取结果，不等待仍在运行的任务."""
+        return {
+            profile: f"{task.result()}"
+            for profile, task in self.tasks.items()
+            if task.done() and not task.cancelled() and task.exception() is None
+        }
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+
+
+# 当前请求的预取结果，为None时没有预取
+PREFETCH: ContextVar[Prefetch | None] = ContextVar("prefetch", default=None)
+
+
+def start_prefetch(request: str) -> Prefetch:
+    """根据请求中的线索开始预取，并设为当前请求的预取结果."""
+    prefetch = Prefetch()
+    if has_cue(request, WEATHER_CUES) or (
+        has_cue(request, INDOOR_AMBIGUOUS_CUES) and has_cue(request, OUTDOOR_CUES)
+    ):
+        _logger.info("Prefetch weather information.")
+        prefetch.start(weather_tool_agent())
+    PREFETCH.set(prefetch)
+    return prefetch
+
+
+async def get_prefetched(profile: str, arguments=None) -> str | None:
+    """无需参数的工具调用可以使用预取的结果."""
+    prefetch = PREFETCH.get()
+    if prefetch is None or arguments:
+        return None
+    return await prefetch.get(profile)
+
+
+def prefetched_context() -> str:
+    """已经完成的预取结果，每个工具一行（工具名称: 返回信息），用于放入Agent的输入."""
+    prefetch = PREFETCH.get()
+    if prefetch is None:
+        return ""
+    return "\n".join(f"{profile}: {result}" for profile, result in prefetch.ready().items())
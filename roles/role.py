@@ -1,4 +1,6 @@
 # from backend.agents.environment import Environment
+import asyncio
+
 from pydantic import BaseModel
 from ..memory import Memory
 from ..actions.action import Action
@@ -60,6 +62,7 @@ class RoleContext:
         self.state = 0
         self.todo = None
         self.watch = set()
+        self.mailbox: asyncio.Queue[Message] = asyncio.Queue()  # 环境投递给自己的、尚未观察的消息
 
     @property
     def important_memory(self) -> list[Message]:
@@ -112,6 +115,15 @@ class Role:
                 f"{idx}. {action}"
             )  # idx 是 enumerate(actions) 生成的索引值，它表示 actions 列表中当前遍历的元素的索引（从 0 开始计数）。
 
+    @property
+    def has_mail(self) -> bool:
+        """是否有尚未观察的新消息."""
+        return not self._rc.mailbox.empty()
+
+    def deliver(self, message: Message):
+        """由环境调用，将发给自己的消息投递到邮箱."""
+        self._rc.mailbox.put_nowait(message)
+
     def _watch(self, actions: list[str]):
         """监听对应的行为."""
         self._rc.watch.update(actions)
@@ -177,18 +189,16 @@ class Role:
         if not self._rc.env:
             return 0
 
-        env_msgs = self._rc.env.memory.get()  # get()在无参数的情况下返回所有的消息
         received = []
-        received = [
-            i for i in env_msgs if self.profile in i.send_to
-        ]  # 将所有接受者是自己（当前角色）的消息加入到received列表中
+        while not self._rc.mailbox.empty():
+            received.append(self._rc.mailbox.get_nowait())
 
         _logger.info(f"{self._setting} received: {received}")
         _logger.info(f"{self._setting} history: {self._rc.history}")
 
         news = self._rc.memory.find_news(
             received
-        )  # Memory.find_news()方法返回的是received中所有新消息的列表
+        )  # Memory.find_news()方法按id返回received中尚未记住的消息
         _logger.info(f"{self._setting} news: {news}")
 
         for i in news:
@@ -214,7 +224,7 @@ class Role:
 
     def recv(self, message: Message) -> None:
         """Add message to history."""
-        if message in self._rc.memory.get():
+        if message in self._rc.memory:
             return
         # 如果有附加信息，先将附加信息加入运行时上下文。
         if message.attachment is not None:
@@ -254,6 +264,7 @@ class Role:
     def reset(self):
         """重置角色状态."""
         self._rc.memory = Memory()
+        self._rc.mailbox = asyncio.Queue()
         self._rc.state = 0
         self._rc.todo = None
         self._llm.reset()
@@ -0,0 +1,100 @@
+"""流式输出：将LLM逐步生成的、面向用户的回复内容推送给对话实体."""
+
+import json
+import re
+from collections.abc import Callable
+from contextvars import ContextVar
+
+from .utils.logs import _logger
+
+
+class ResponseStream:
+    """一次对话请求的流式输出通道，由对话实体创建，on_delta接收增量文本."""
+
+    def __init__(self, on_delta: Callable[[str], None]):
+        self.on_delta = on_delta
+        self.emitted = False  # 是否已经向用户推送过内容
+
+    def emit(self, delta: str):
+        if not delta:
+            return
+        self.emitted = True
+        try:
+            self.on_delta(delta)
+        except Exception as ex:  # 推送失败不应影响Agent本身的运行
+            _logger.error(f"Fail to emit response delta: {ex!r}")
+
+
+# 当前请求的流式输出通道，为None时不开启流式输出
+RESPONSE_STREAM: ContextVar[ResponseStream | None] = ContextVar(
+    "response_stream", default=None
+)
+# 当前子任务的Finish回复是否就是最终回复（只有一个子任务时才为True，否则最终回复由Synthesizer生成）
+STREAM_FINISH: ContextVar[bool] = ContextVar("stream_finish", default=False)
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonFieldStreamer:
+    """从不断增长的JSON文本中增量提取某个字符串字段的值.
+
+    actions不为None时，只有当Action_type字段属于actions时才推送内容；
+    若目标字段先于Action_type生成，则先缓存，待Action_type确定后再推送。
+    """
+
+    def __init__(self, stream: ResponseStream, field: str, actions: set[str] | None = None):
+        self.stream = stream
+        self.actions = actions
+        self._field_pattern = re.compile(rf'"{re.escape(field)}"\s*:\s*"')
+        self._action_pattern = re.compile(r'"Action_type"\s*:\s*"([^"]*)"')
+        self._value = ""  # 已解码的字段值
+        self._pos = None  # 字段值在原文本中已解码到的位置
+        self._sent = 0  # 已推送的字符数
+        self._closed = False
+
+    def feed(self, text: str):
+        """传入目前为止LLM生成的全部文本."""
+        if self._pos is None:
+            match = self._field_pattern.search(text)
+            if match is None:
+                return
+            self._pos = match.end()
+        if not self._closed:
+            self._decode(text)
+        if self._allowed(text) and len(self._value) > self._sent:
+            self.stream.emit(self._value[self._sent :])
+            self._sent = len(self._value)
+
+    def _allowed(self, text: str) -> bool:
+        if self.actions is None:
+            return True
+        match = self._action_pattern.search(text)
+        return match is not None and match.group(1) in self.actions
+
+    def _decode(self, text: str):
+        i = self._pos
+        while i < len(text):
+            ch = text[i]
+            if ch == '"':
+                self._closed = True
+                break
+            if ch != "\\":
+                self._value += ch
+                i += 1
+                continue
+            # 转义序列不完整时等待更多文本
+            if i + 1 >= len(text):
+                break
+            esc = text[i + 1]
+            if esc == "u":
+                if i + 6 > len(text):
+                    break
+                try:
+                    self._value += json.loads(f'"{text[i:i + 6]}"')
+                except ValueError:
+                    self._value += text[i : i + 6]
+                i += 6
+                continue
+            self._value += _ESCAPES.get(esc, esc)
+            i += 2
+        self._pos = i
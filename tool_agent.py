@@ -1,12 +1,10 @@
 from .llm import LLM
-import json
 import aiohttp
-import ast
 from abc import ABC
-from .context_assistant import get_all_states, find_entity_by_entity_id
+from .context_assistant import find_entity_by_entity_id
 from datetime import datetime, timedelta
-import json
 from .configs import CONFIG
+from .utils.parser import ParseError, parse_json
 
 
 class tool_agent(ABC):
@@ -24,15 +22,7 @@ class tool_agent(ABC):
         pass
 
     def parse_output(self, output: str) -> dict:
-        if output.startswith("```json"):
-            output = output[7:]
-            output = output[:-3]
-            return json.loads(output.strip())
-        if output.startswith("```"):
-            output = output[3:]
-            output = output[:-3]
-            return json.loads(output.strip())
-        return json.loads(output.strip())
+        return parse_json(output, dict)
 
 
 class weather_tool_agent(tool_agent):
@@ -42,8 +32,7 @@ class weather_tool_agent(tool_agent):
         self.argument = ""
 
     async def run(self, request):
-        await get_all_states()  # 刷新states.json
-        zone_home = find_entity_by_entity_id("zone.home")
+        zone_home = find_entity_by_entity_id("zone.home")  # STATE_STORE随状态变化实时更新
         la = zone_home["attributes"]["latitude"]
         laf = f"{la:.2f}"
         lo = zone_home["attributes"]["longitude"]
@@ -177,7 +166,7 @@ class map_tool_agent(tool_agent):
             return output  # 如果已经是列表，直接返回
         if isinstance(output, str):
             try:
-                return ast.literal_eval(output)  # 安全地解析字符串为 Python 对象
-            except (ValueError, SyntaxError):
+                return parse_json(output, list)
+            except ParseError:
                 pass
         return []  # 解析失败时返回空列表
@@ -3,24 +3,211 @@
 # 2. translate the tap to automation yaml
 from .utils.singleton import Singleton
 from .utils.logs import _logger
-from .utils.utils import append_file
+import asyncio
 import time
+from collections.abc import Callable
+from typing import Any, NamedTuple
 from .configs import CONFIG
-from .context_assistant import find_entity_by_field_mac
+from .context_assistant import (
+    FIELD_ALIASES,
+    find_entity_by_entity_id,
+    find_entity_by_field_mac,
+)
 import os
 import requests
+import yaml
+
+try:
+    from homeassistant.components.automation.config import async_validate_config_item
+except ImportError:  # 没有该接口的HA版本中，写入后通过HTTP check_config检查配置
+    async_validate_config_item = None
+
+# TAP中时间类trigger对应的实体
+TIME_TRIGGER_ENTITIES = {
+    "Date": "sensor.date",
+    "Time": "sensor.time",
+    "Time & Date": "sensor.time_date",
+}
+
+
+def _to_bool(value_str: str) -> bool:
+    return value_str.lower() == "true"
+
+
+def coercer_for(p_format: str | None) -> Callable[[str], Any]:
+    """根据属性的format返回将指令中的值字符串转换为属性值的函数."""
+    if p_format == "bool":
+        return _to_bool
+    if p_format and "int" in p_format:
+        return int
+    if p_format and "float" in p_format:
+        return float
+    return str
+
+
+def check_value(property: dict, value_str: str) -> str | None:
+    """检查值是否符合属性的format、value-range和value-list，返回错误信息，符合时返回None."""
+    p_format = property.get("format")
+    if p_format == "bool" and value_str.lower() not in ("true", "false"):
+        return f"值{value_str}不是bool类型，应为true或false"
+    try:
+        value = coercer_for(p_format)(value_str)
+    except ValueError:
+        return f"值{value_str}不符合属性的格式{p_format}"
+    value_range = property.get("value-range")
+    if value_range and isinstance(value, (int, float)) and not isinstance(value, bool):
+        if not value_range[0] <= value <= value_range[1]:
+            return f"值{value}超出取值范围[{value_range[0]}, {value_range[1]}]"
+    value_list = property.get("value-list")
+    if value_list and value not in [item.get("value") for item in value_list]:
+        choices = ", ".join(
+            f"{item.get('value')}({item.get('description', '')})" for item in value_list
+        )
+        return f"值{value}不在可选值中，可选值为：{choices}"
+    return None
+
+
+class CommandTarget(NamedTuple):
+    """一条设备指令（id.service.property）对应的执行目标."""
+
+    entity_id: str
+    field: str  # xiaomi_miot.set_property使用的service.property
+    coerce: Callable[[str], Any]
+    property: dict  # all_context中该属性的信息
+
+
+def parse_command(command_str: str) -> tuple[int, str, str]:
+    """将"id.service.property = value"拆分为(id, service.property, value)."""
+    service_str, value_str = command_str.split("=", 1)
+    id_str, field_str = service_str.strip().split(".", 1)
+    return int(id_str), field_str.strip(), value_str.strip()
 
 
 class Translator(metaclass=Singleton):
     def __init__(self, hass):
         self.hass = hass
+        # (设备id, service.property) -> CommandTarget，设备目录（catalog_version）更新时重建
+        self.targets: dict[tuple[int, str], CommandTarget] = {}
+        self.devices: dict[int, dict] = {}  # 设备id -> all_context中的设备，用于校验指令
+        self._targets_version = None
+        self._last_automation_id = 0
+
+    def build_command_table(self):
+        """根据all_context预先计算所有设备属性对应的实体和值转换函数."""
+        macs = {
+            device.get("id"): device.get("mac_address", "")
+            for device in CONFIG.hass_data.get("miot_devices", [])
+        }
+        targets = {}
+        for device in CONFIG.hass_data.get("all_context", []):
+            mac_address = macs.get(device["id"], "")
+            for service_name, service in device.get("services", {}).items():
+                for property_name, property in service.items():
+                    field = f"{service_name}.{property_name}"
+                    entity = find_entity_by_field_mac(field, mac_address)
+                    if entity is None:
+                        continue
+                    targets[(device["id"], field)] = CommandTarget(
+                        entity["entity_id"],
+                        field,
+                        coercer_for(property.get("format")),
+                        property,
+                    )
+        self.targets = targets
+        self.devices = {
+            device["id"]: device for device in CONFIG.hass_data.get("all_context", [])
+        }
+        self._targets_version = CONFIG.hass_data.get("catalog_version")
+        _logger.debug(f"Command table built: {len(targets)} targets")
+
+    def _lookup(self, id_num: int, field_str: str) -> CommandTarget | None:
+        """查表时未命中（例如实体在目录加载之后才出现），按设备的mac地址查找实体并补充到表中."""
+        target = self.targets.get((id_num, field_str))
+        if target is not None and find_entity_by_entity_id(target.entity_id) is not None:
+            return target
+
+        mac_address = next(
+            (
+                device.get("mac_address", "")
+                for device in CONFIG.hass_data["miot_devices"]
+                if device.get("id", -1) == id_num
+            ),
+            "",
+        )
+        entity = find_entity_by_field_mac(field_str, mac_address)
+        if entity is None:
+            return None
+        service_name, _, property_name = field_str.partition(".")
+        property = (
+            self.devices.get(id_num, {})
+            .get("services", {})
+            .get(service_name, {})
+            .get(property_name, {})
+        )
+        target = CommandTarget(
+            entity["entity_id"], field_str, coercer_for(property.get("format")), property
+        )
+        self.targets[(id_num, field_str)] = target
+        return target
+
+    def _ensure_table(self):
+        if self._targets_version != CONFIG.hass_data.get("catalog_version"):
+            self.build_command_table()
+
+    def resolve(self, id_num: int, field_str: str) -> CommandTarget | None:
+        """查找指令的执行目标；三段式的field（例如子服务）找不到时，去掉第一段后再查找."""
+        self._ensure_table()
+        target = self._lookup(id_num, field_str)
+        parts = field_str.split(".")
+        if target is None and len(parts) == 3:
+            target = self._lookup(id_num, f"{parts[1]}.{parts[2]}")
+        return target
+
+    def validate_command(self, command_str: str) -> str | None:
+        """根据设备目录检查一条指令（设备、属性、写权限、格式和取值范围），返回错误信息，有效时返回None."""
+        try:
+            id_num, field_str, value_str = parse_command(command_str)
+        except ValueError:
+            return f"{command_str}：指令格式应为 id.service.property = <value>"
+        self._ensure_table()
+        device = self.devices.get(id_num)
+        if device is None:
+            return f"{command_str}：不存在id为{id_num}的设备"
+
+        services = device.get("services", {})
+        parts = field_str.split(".")
+        property = None
+        if len(parts) == 2:
+            property = services.get(parts[0], {}).get(parts[1])
+        elif len(parts) == 3:
+            # 与执行时一致，三段式的field去掉第一段后查找
+            property = services.get(parts[1], {}).get(parts[2])
+        if property is None:
+            return f"{command_str}：设备{id_num}没有属性{field_str}"
+        if "write" not in property.get("access", []):
+            return f"{command_str}：属性{field_str}是只读的，不能修改"
+        error = check_value(property, value_str)
+        if error is not None:
+            return f"{command_str}：{error}"
+        if field_str != "air_conditioner.target_temperature" and self.resolve(
+            id_num, field_str
+        ) is None:
+            return f"{command_str}：找不到设备{id_num}的属性{field_str}对应的实体"
+        return None
+
+    def validate_commands(self, commands: list[str]) -> list[str]:
+        """检查一组指令，返回所有错误信息."""
+        errors = []
+        for command in commands:
+            error = self.validate_command(command)
+            if error is not None:
+                errors.append(error)
+        return errors
 
     async def run_single_command(self, command_str: str):
         """用于将DeviceControler的命令翻译并执行."""
         print("执行命令：" + command_str)
-        service_str = command_str.split("=")[0].strip()  # 等号左边的部分
-        value_str = command_str.split("=")[1].strip()  # 等号右边的部分
-        id_str, field_str = service_str.split(".", 1)
+        id_num, field_str, value_str = parse_command(command_str)
 
         # TODO 特殊情况：修改空调温度，目前只能修改mc2这台空调
         if field_str == "air_conditioner.target_temperature":
@@ -35,50 +222,30 @@ class Translator(metaclass=Singleton):
             )
             return
 
-        # 找到id_str对应的设备的mac_address
-        id_num = int(id_str)
-        miot_devices = CONFIG.hass_data["miot_devices"]
-        mac_address = ""
-        for device in miot_devices:
-            if device.get("id", -1) == id_num:  # 若"id"字段不存在，则返回-1
-                mac_address = device.get(
-                    "mac_address", ""
-                )  # 若"mac_address"字段不存在，则返回空串
-                break
-
-        parts = field_str.split(".")
-        entity = find_entity_by_field_mac(field_str, mac_address)
-        if entity is None and len(parts) == 3:
-            field_str = f"{parts[1]}.{parts[2]}"  # 更新field_str再次搜索
-            entity = find_entity_by_field_mac(field_str, mac_address)
-            if entity is not None:  # 搜索成功
-                parts = field_str.split(".")
-            else:
-                print(f"Can't find state with field_str {field_str}")
-                return
-        service_name = parts[0]
-        property_name = ".".join(parts[1:])
-        entity_id = entity["entity_id"]
-
-        for device in CONFIG.hass_data["all_context"]:
-            if device.get("id", -1) == id_num:
-                services = device.get("services", {})
-                service = services[service_name]
-                property = service[property_name]
-                p_format = property["format"]
-
-                if p_format == "bool":
-                    value = value_str.lower() == "true"
-                elif "int" in p_format:
-                    value = int(value_str)
-                elif "float" in p_format:
-                    value = float(value_str)
-                else:
-                    value = value_str
-                break
-        service_data = {"entity_id": entity_id, "field": field_str, "value": value}
+        target = self.resolve(id_num, field_str)
+        if target is None:
+            print(f"Can't find state with field_str {field_str}")
+            return
+        service_data = {
+            "entity_id": target.entity_id,
+            "field": target.field,
+            "value": target.coerce(value_str),
+        }
         await self.hass.services.async_call("xiaomi_miot", "set_property", service_data)
 
+    async def run_commands(self, commands: list[str]):
+        """并发执行一组设备指令；全部执行结束后，若有指令失败则抛出第一个异常."""
+        results = await asyncio.gather(
+            *(self.run_single_command(command) for command in commands),
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        for command, result in zip(commands, results):
+            if isinstance(result, Exception):
+                _logger.error(f"Command {command} failed: {result!r}")
+        if errors:
+            raise errors[0]
+
     async def _check_config(self):
         access_token = CONFIG.hass_data["access_token"]
         url = f"http://127.0.0.1:8123/api/config/core/check_config"
@@ -104,250 +271,259 @@ class Translator(metaclass=Singleton):
             _logger.error(f"Connection error was: {repr(ex)}")
             return "failed_to_connect"
 
-    async def add_automation(self, new_automation: str):
-        """将新的自动化配置添加到automations.yaml文件中，并检查配置有效性."""
-        _logger.debug("add_automation")
-        # config_path = "/config"
-        # config_path改为绝对路径，原先内容是上面这行
-        config_path = "/workspaces/HomeAssistant/config"
-
-        automation_path = os.path.join(config_path, "automations.yaml")
-
-        # if there is only "[]" in automations.yaml, remove it first
-        with open(automation_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        if len(lines) == 1 and lines[0].strip() == "[]":
-            with open(automation_path, "w", encoding="utf-8") as f:
-                f.write("")
+    def begin_automations(self) -> "AutomationTransaction":
+        """开始一次自动化部署事务，多条自动化暂存后一并写入、检查和重载."""
+        return AutomationTransaction(self)
 
-        # copy the automations.yaml for bak
-        automation_bak_path = os.path.join(config_path, "automations.yaml.bak")
-        with open(automation_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        with open(automation_bak_path, "w", encoding="utf-8") as f:
-            f.writelines(lines)
+    def new_automation_id(self) -> int:
+        """生成自动化id（毫秒时间戳），同一毫秒内生成多条自动化时依次加一，保证id不重复."""
+        self._last_automation_id = max(
+            int(time.time() * 1000), self._last_automation_id + 1
+        )
+        return self._last_automation_id
 
-        # Ensure the file starts with "---"
-        if not lines:
-            with open(automation_path, "w", encoding="utf-8") as f:
-                f.write("---")
-                f.writelines(lines)
-        append_file(automation_path, new_automation)
-        res_check = await self._check_config()
-        if res_check == "valid":
-            # print("配置文件检查通过")
-            await self.hass.services.async_call("homeassistant", "reload_all")
-            # print("重载配置文件完成")
+    async def add_automation(self, new_automation: dict):
+        """将新的自动化配置添加到automations.yaml文件中，并检查配置有效性."""
+        _logger.debug("add_automation")
+        transaction = self.begin_automations()
+        transaction.stage(new_automation)
+        await transaction.commit()
+
+    def _tap_trigger(self, trigger_str: str) -> dict:
+        """将TAP中的trigger（"id.service.property<op><value>"或时间条件）翻译为HA的trigger."""
+        op = next((op for op in ("==", ">", "<") if op in trigger_str), None)
+        if op is None:
+            raise ValueError(f"invalid trigger: {trigger_str}")
+        trigger_service_str, trigger_value_str = (
+            part.strip() for part in trigger_str.split(op, 1)
+        )
+
+        # trigger与时间相关
+        if trigger_service_str in TIME_TRIGGER_ENTITIES:
+            return {
+                "platform": "state",
+                "entity_id": TIME_TRIGGER_ENTITIES[trigger_service_str],
+                "to": trigger_value_str,
+            }
+
+        trigger_id_str, trigger_field_str = trigger_service_str.split(".", 1)
+        target = self.resolve(int(trigger_id_str), trigger_field_str)
+        if target is None:
+            raise ValueError(f"unable to find entity: {trigger_field_str}")
+        if target.property.get("format") == "bool":
+            trigger_value = 1 if _to_bool(trigger_value_str) else 0
         else:
-            # replace the automations.yaml with the bak file
-            _logger.error("invalid configuration, restore automations.yaml")
-            with open(automation_bak_path, encoding="utf-8") as f:
-                lines = f.readlines()
-            with open(automation_path, "w", encoding="utf-8") as f:
-                f.writelines(lines)
-                # print("已经写入automations.yaml文件")
-
-    async def deploy_tap(self, runOnce: bool, user_input, TAP_json):
-        # user_input仅用于生成自动化的alias
-        _logger.debug("deploy_tap")
-        miot_devices = CONFIG.hass_data["miot_devices"]
-        triggers = TAP_json.get("trigger", "")
-        actions = TAP_json.get("action", "")
+            trigger_value = float(trigger_value_str)
+            if trigger_value.is_integer():
+                trigger_value = int(trigger_value)
+
+        trigger = {
+            "platform": "numeric_state",
+            "entity_id": target.entity_id,
+            # 属性名与实体索引一致，例如illumination_sensor.illumination对应illumination-2-1
+            "attribute": FIELD_ALIASES.get(target.field, target.field),
+        }
+        if op == "==":
+            trigger["above"] = trigger_value - 1
+            trigger["below"] = trigger_value + 1
+        elif op == ">":
+            trigger["above"] = trigger_value
+        else:
+            trigger["below"] = trigger_value
+        return trigger
+
+    def _tap_action(self, action_str: str) -> dict:
+        """将TAP中的action（"id.service.property=<value>"）翻译为xiaomi_miot.set_property."""
+        action_id, action_field_str, action_value_str = parse_command(action_str)
+        action_value_str = action_value_str.lstrip("=").strip()  # 兼容误写为"=="的action
+        target = self.resolve(action_id, action_field_str)
+        if target is None:
+            raise ValueError(f"unable to find entity with field_str:{action_field_str}")
+        return {
+            "service": "xiaomi_miot.set_property",
+            "data": {
+                "entity_id": target.entity_id,
+                "field": target.field,
+                "value": target.coerce(action_value_str),
+            },
+        }
 
-        trigger_str = triggers
-        action_str = actions
+    def build_automation(self, runOnce: bool, user_input, TAP_json) -> dict:
+        """将一个TAP翻译为HA自动化配置（与automations.yaml中的一项结构相同）."""
+        trigger_str = TAP_json.get("trigger", "")
+        action_str = TAP_json.get("action", "")
         _logger.info("trigger_str: {}".format(trigger_str))
         _logger.info("action_str: {}".format(action_str))
 
-        # ---------------------------解析action_str----------------------------
+        automation_id = self.new_automation_id()
+        # 只运行一次的自动化alias必须和id一致，便于后续关闭
+        alias = user_input if not runOnce else automation_id
+        automation = {
+            "id": str(automation_id),
+            "alias": str(alias),
+            "trigger": [self._tap_trigger(trigger_str)],
+            "action": [self._tap_action(action_str)],
+        }
+        if runOnce:
+            # 如果该自动化只希望运行一次，运行后关闭自身
+            automation["action"].append(
+                {
+                    "service": "automation.turn_off",
+                    "target": {"entity_id": f"automation.{automation_id}"},
+                }
+            )
+        return automation
+
+    async def deploy_tap(
+        self,
+        runOnce: bool,
+        user_input,
+        TAP_json,
+        transaction: "AutomationTransaction | None" = None,
+    ):
+        """将TAP翻译为自动化；传入transaction时只暂存，由调用方统一提交.
+
+        TAP无法翻译时返回错误信息，否则返回None。
+        """
+        # user_input仅用于生成自动化的alias
+        _logger.debug("deploy_tap")
         try:
-            action_service_str = action_str.split("=")[0].strip()
-            action_value_str = action_str.split("=")[1].strip()
-            action_id_str, action_field_str = action_service_str.split(".", 1)
-            action_service_name, *action_property_parts = action_field_str.split(".")
-            action_property_name = ".".join(action_property_parts)
-            action_id = int(action_id_str)
-        except ValueError as e:
-            print(f"解析错误: {e}")
-
-        action_mac_address = ""
-        for device in miot_devices:
-            if device.get("id", -1) == action_id:
-                action_mac_address = device.get("mac_address", "")
-                break
-        # print(action_field_str)
-        # print(action_mac_address)
-        action_entity = find_entity_by_field_mac(action_field_str, action_mac_address)
-        if action_entity is None:  # 如果三段结构的field_str找不到，用后两段继续搜索
-            parts = action_field_str.split(".")
-            if len(parts) == 3:
-                action_field_str = f"{parts[1]}.{parts[2]}"
-                action_entity = find_entity_by_field_mac(
-                    action_field_str, action_mac_address
-                )
-            if action_entity is None:  # 还是找不到，打印错误信息
-                print(f"unable to find entity with field_str:{action_field_str}")
-            else:  # 如果能找到，其他内容也要更新
-                action_service_name, *action_property_parts = action_field_str.split(
-                    "."
-                )
-                action_property_name = ".".join(action_property_parts)
-        _logger.info("action_entity: {}".format(action_entity))
-
-        action_entity_id = action_entity["entity_id"]
-
-        for device in CONFIG.hass_data["all_context"]:
-            if device.get("id", -1) == action_id:
-                services = device.get("services", {})
-                service = services[action_service_name]
-                # print(service)
-                property = service[action_property_name]
-                p_format = property["format"]
-
-                if p_format == "bool":
-                    action_value = action_value_str.lower() == "true"
-                elif "int" in p_format:
-                    action_value = int(action_value_str)
-                elif "float" in p_format:
-                    action_value = float(action_value_str)
-                else:
-                    action_value = action_value_str
-                break
-
-        ops = ["==", ">", "<"]
-        for op in ops:
-            if op in trigger_str:
-                break
-
-        # ---------------------------解析trigger_str----------------------------
-        trigger_service_str = trigger_str.split(op)[0].strip()  # trigger对应的服务
-        trigger_value_str = trigger_str.split(op)[1].strip()  # trigger对应的值
-
-        # 检查自动化是否与时间相关
-        time_triggers = ["Date", "Time", "Time & Date"]
-        time_related = False
-        if trigger_service_str in time_triggers:
-            time_related = True
-
-        # 处理并非以时间为trigger的自动化
-        if not time_related:
-            try:
-                trigger_id_str, trigger_field_str = trigger_service_str.split(".", 1)
-                trigger_service_name, *trigger_property_parts = trigger_field_str.split(
-                    "."
-                )
-                trigger_property_name = ".".join(trigger_property_parts)
-                trigger_id = int(trigger_id_str)
-            except ValueError as e:
-                print(f"解析错误: {e}")
-
-            if trigger_id == -1:
-                pass
-            else:
-                trigger_mac_address = ""
-                for device in miot_devices:
-                    if device.get("id", -1) == trigger_id:
-                        trigger_mac_address = device.get("mac_address", "")
-                        break
-                if trigger_field_str == "illumination_sensor.illumination":
-                    trigger_field_str = "illumination-2-1"
-                trigger_entity = find_entity_by_field_mac(
-                    trigger_field_str, trigger_mac_address
-                )
-                if (
-                    trigger_entity is None
-                ):  # 如果三段形式的field_str找不到，用后两段再次尝试搜索
-                    parts = trigger_field_str.split(".")
-                    if len(parts) == 3:
-                        trigger_field_str = f"{parts[1]}.{parts[2]}"
-                        trigger_entity = find_entity_by_field_mac(
-                            trigger_field_str, trigger_mac_address
-                        )
-                    if trigger_entity is None:  # 如果还是找不到，打印错误信息
-                        print(f"unable to find entity: {trigger_field_str}")
-                    else:  # 如果能找到，其他部分也要更新
-                        trigger_service_name, *trigger_property_parts = (
-                            trigger_field_str.split(".")
-                        )
-                        trigger_property_name = ".".join(trigger_property_parts)
-                _logger.info("trigger_entity: {}".format(trigger_entity))
-                trigger_entity_id = trigger_entity["entity_id"]
-                for device in CONFIG.hass_data["all_context"]:
-                    if device.get("id", -1) == trigger_id:
-                        services = device.get("services", {})
-                        service = services[trigger_service_name]
-                        property = service[trigger_property_name]
-                        p_format = property["format"]
-
-                        if p_format == "bool":
-                            bool_value = trigger_value_str.lower() == "true"
-                            if bool_value:
-                                trigger_value = 1
-                            else:
-                                trigger_value = 0
-                        elif "int" in p_format or "float" in p_format:
-                            trigger_value = int(trigger_value_str)
-                        else:
-                            trigger_value = trigger_value_str
-                        break
-
-        # 生成自动化中的trigger部分
-        if op == "==":
-            # trigger与时间无关
-            if not time_related:
-                trigger_yaml = f"""trigger: numeric_state
-      entity_id: {trigger_entity_id}
-      attribute: {trigger_field_str}
-      above: {trigger_value - 1}
-      below: {trigger_value + 1}"""
-
-            # trigger与时间相关
-            else:
-                if trigger_service_str == "Date":
-                    trigger_entity_id = "sensor.date"
-                elif trigger_service_str == "Time":
-                    trigger_entity_id = "sensor.time"
-                else:
-                    trigger_entity_id = "sensor.time_date"
-                trigger_yaml = f"""platform: state
-      entity_id: {trigger_entity_id}
-      to: '{trigger_value_str}'"""
+            new_automation = self.build_automation(runOnce, user_input, TAP_json)
+        except (ValueError, KeyError) as ex:
+            _logger.error(f"Failed to translate TAP {TAP_json}: {ex!r}")
+            return f"无法翻译：{ex}"
+        _logger.info("new automation: {}".format(new_automation))
+        if transaction is not None:
+            transaction.stage(new_automation, TAP_json)
+        else:
+            await self.add_automation(new_automation)
+        return None
 
-        elif op == ">":
-            trigger_yaml = f"""platform: numeric_state
-      entity_id: {trigger_entity_id}
-      attribute: {trigger_field_str}
-      above: {trigger_value}"""
-
-        elif op == "<":
-            trigger_yaml = f"""- platform: numeric_state
-      entity_id: {trigger_entity_id}
-      attribute: {trigger_field_str}
-      below: {trigger_value}"""
-
-        timestamp = int(time.time() * 1000)
-        # 只运行一次的自动化啊alias必须和id一致，便于后续关闭
-        alias = user_input if not runOnce else timestamp
-
-        new_automation = f"""
-- id: '{timestamp}'
-  alias: {alias}
-  trigger:
-      {trigger_yaml}
-  action:
-    - service: xiaomi_miot.set_property
-      data:
-        entity_id: {action_entity_id}
-        field: {action_field_str}
-        value: {action_value}"""
-
-        run_once_part = f"""
-    - service: automation.turn_off
-      target:
-        entity_id: automation.{timestamp}"""
 
-        if runOnce:
-            # 如果该自动化只希望运行一次，添加run_once部分
-            new_automation += run_once_part
-        _logger.info("new automation yaml: {}".format(new_automation))
-        await self.add_automation(new_automation)
+    async def check_tap(self, runOnce: bool, user_input, TAP_json) -> str | None:
+        """检查TAP能否翻译为有效的自动化，返回错误信息，有效时返回None；不会部署该自动化."""
+        try:
+            automation = self.build_automation(runOnce, user_input, TAP_json)
+        except (ValueError, KeyError) as ex:
+            return f"无法翻译：{ex}"
+        return await validate_automation(self.hass, automation)
+
+
+def check_automation(automation: dict) -> str | None:
+    """不依赖HA的结构检查，返回错误信息，通过时返回None."""
+    for key in ("id", "alias", "trigger", "action"):
+        if not automation.get(key):
+            return f"missing {key}"
+    for trigger in automation["trigger"]:
+        if trigger.get("platform") not in ("state", "numeric_state"):
+            return f"unsupported trigger platform: {trigger.get('platform')}"
+        if not isinstance(trigger.get("entity_id"), str):
+            return "trigger without entity_id"
+        if trigger["platform"] == "numeric_state":
+            above, below = trigger.get("above"), trigger.get("below")
+            if above is None and below is None:
+                return "numeric_state trigger needs above or below"
+            if above is not None and below is not None and above >= below:
+                return f"empty numeric_state range: above {above}, below {below}"
+    for action in automation["action"]:
+        if "." not in str(action.get("service", "")):
+            return f"invalid service: {action.get('service')}"
+    return None
+
+
+async def validate_automation(hass, automation: dict) -> str | None:
+    """在本地校验自动化配置（结构检查和HA的automation配置校验），返回错误信息，有效时返回None."""
+    error = check_automation(automation)
+    if error is None and async_validate_config_item is not None:
+        try:
+            await async_validate_config_item(hass, automation["id"], automation)
+        except Exception as ex:
+            error = str(ex)
+    return error
+
+
+class AutomationTransaction:
+    """批量部署自动化：暂存多条自动化，在本地校验后只原子地写入一次automations.yaml，
+    并只重载automation域；无法在本地校验时通过HTTP检查配置，配置无效时恢复原文件.
+    """
+
+    # config_path = "/config"
+    # config_path改为绝对路径，原先内容是上面这行
+    config_path = "/workspaces/HomeAssistant/config"
+
+    def __init__(self, translator: Translator):
+        self.translator = translator
+        self.staged: list[dict] = []
+        self.sources: list = []  # 与staged一一对应，生成每条自动化的TAP
+        self.failed: list[tuple] = []  # 提交后未能部署的(TAP, 错误信息)
+        self.automation_path = os.path.join(self.config_path, "automations.yaml")
+        self.automation_bak_path = os.path.join(self.config_path, "automations.yaml.bak")
+
+    def stage(self, new_automation: dict, source=None):
+        """暂存一条自动化，source为生成它的TAP，用于报告部署失败的自动化."""
+        self.staged.append(new_automation)
+        self.sources.append(new_automation if source is None else source)
+
+    @staticmethod
+    def _replace(file_path: str, content: str):
+        """先写入临时文件再替换，HA不会读到写了一半的文件."""
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+
+    def _write(self, automations: list[dict]):
+        with open(self.automation_path, encoding="utf-8") as f:
+            original = f.read()
+        # copy the automations.yaml for bak
+        self._replace(self.automation_bak_path, original)
+
+        # if there is only "[]" in automations.yaml, remove it first
+        content = "" if original.strip() == "[]" else original
+        # Ensure the file starts with "---"
+        if not content:
+            content = "---"
+        if not content.endswith("\n"):
+            content += "\n"
+        self._replace(
+            self.automation_path,
+            content + yaml.safe_dump(automations, sort_keys=False, allow_unicode=True),
+        )
+
+    def _restore(self):
+        with open(self.automation_bak_path, encoding="utf-8") as f:
+            original = f.read()
+        self._replace(self.automation_path, original)
+
+    async def commit(self) -> bool:
+        """校验并写入所有暂存的自动化，全部有效并成功部署时返回True."""
+        if not self.staged:
+            return True
+        hass = self.translator.hass
+        staged, self.staged = self.staged, []
+        sources, self.sources = self.sources, []
+        automations, deployed = [], []
+        for automation, source in zip(staged, sources):
+            error = await validate_automation(hass, automation)
+            if error is not None:
+                # 无效的自动化不写入文件，避免写入后再检查、回滚
+                _logger.error(f"Invalid automation {automation}: {error}")
+                self.failed.append((source, error))
+                continue
+            automations.append(automation)
+            deployed.append(source)
+        if not automations:
+            return False
+
+        _logger.debug(f"commit {len(automations)} automations")
+        await hass.async_add_executor_job(self._write, automations)
+        if async_validate_config_item is None:
+            res_check = await self.translator._check_config()
+            if res_check != "valid":
+                # replace the automations.yaml with the bak file
+                _logger.error("invalid configuration, restore automations.yaml")
+                await hass.async_add_executor_job(self._restore)
+                self.failed.extend((source, f"配置检查未通过：{res_check}") for source in deployed)
+                return False
+        await hass.services.async_call("automation", "reload")
+        return len(automations) == len(staged)
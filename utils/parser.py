@@ -0,0 +1,149 @@
+"""解析LLM输出的JSON：容忍代码块标记、前后多余的文字、尾随逗号等常见的格式问题."""
+
+import ast
+import json
+from typing import Any
+
+
+class ParseError(ValueError):
+    """LLM的输出无法解析，或缺少必需的字段；错误信息会发回给LLM，用于修正回复."""
+
+
+def strip_fences(text: str) -> str:
+    """去掉```json ... ```代码块标记."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else text[3:]
+        if text.startswith("json"):
+            text = text[4:]
+        end = text.rfind("```")
+        if end != -1:
+            text = text[:end]
+    return text.strip()
+
+
+def extract_json(text: str, opener: str) -> str:
+    """提取第一个以opener（"{"或"["）开始的完整JSON值；没有闭合时返回到文本末尾."""
+    start = text.find(opener)
+    if start == -1:
+        raise ParseError(f"输出中没有以{opener}开始的JSON")
+    depth = 0
+    in_str = False
+    escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_str:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start : i + 1]
+    return text[start:]
+
+
+def repair_json(text: str) -> str:
+    """修复常见的格式问题：尾随逗号、全角逗号、对象之间缺少逗号、字符串中的换行."""
+    out: list[str] = []
+    in_str = False
+    escape = False
+
+    def last_char():
+        j = len(out) - 1
+        while j >= 0 and out[j].isspace():
+            j -= 1
+        return j
+
+    for ch in text:
+        if in_str:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_str = False
+            elif ch == "\n":
+                ch = "\\n"
+            out.append(ch)
+            continue
+        if ch == '"':
+            in_str = True
+        elif ch == "，":
+            ch = ","
+        elif ch in "}]":
+            j = last_char()
+            if j >= 0 and out[j] == ",":
+                del out[j]
+        elif ch == "{":
+            j = last_char()
+            if j >= 0 and out[j] == "}":
+                out.append(",")
+        out.append(ch)
+    return "".join(out)
+
+
+def _loads(text: str):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    repaired = repair_json(text)
+    try:
+        return json.loads(repaired)
+    except ValueError as ex:
+        error = ex
+    try:
+        # 单引号、True/False/None等Python风格的输出
+        return ast.literal_eval(repaired)
+    except (ValueError, SyntaxError):
+        raise ParseError(f"不是合法的JSON：{error}") from error
+
+
+def parse_json(text: str, expected: type = dict) -> Any:
+    """解析LLM输出中的JSON对象（expected=dict）或数组（expected=list）."""
+    if not isinstance(text, str):
+        raise ParseError("输出为空")
+    text = strip_fences(text)
+    try:
+        data = json.loads(text)
+    except ValueError:
+        if expected is list and "[" not in text and "{" in text:
+            # 省略了方括号、直接输出的若干个对象
+            data = _loads(f"[{text[text.find('{') : text.rfind('}') + 1]}]")
+        else:
+            data = _loads(extract_json(text, "{" if expected is dict else "["))
+
+    if expected is list and isinstance(data, dict):
+        # {"subtasks": [...]}这样只包了一层的数组，或只有一个对象的数组
+        values = list(data.values())
+        data = values[0] if len(values) == 1 and isinstance(values[0], list) else [data]
+    if expected is dict and isinstance(data, list):
+        data = next((item for item in data if isinstance(item, dict)), data)
+    if not isinstance(data, expected):
+        raise ParseError(f"输出应为JSON{'对象' if expected is dict else '数组'}")
+    return data
+
+
+def require_keys(data: dict, keys) -> dict:
+    missing = [key for key in keys if key not in data]
+    if missing:
+        raise ParseError(f"缺少字段：{', '.join(missing)}")
+    return data
+
+
+def parse_action(text: str, schemas: dict[str, tuple[str, ...]]) -> dict:
+    """解析带Action_type的回复，schemas为每种Action_type必需的字段."""
+    data = parse_json(text, dict)
+    action_type = str(data.get("Action_type", "")).strip()
+    if action_type not in schemas:
+        raise ParseError(f"Action_type必须是{', '.join(schemas)}之一")
+    data["Action_type"] = action_type
+    return require_keys(data, schemas[action_type])